@@ -1,17 +1,40 @@
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta
+from collections import Counter
+from datetime import date, datetime
+
+# Ordinale proleptico (date.toordinal) del 1970-01-01
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def _event_window(ords, cur_ord, lookahead):
+    """Indici [lo, hi) degli eventi con ordinale in [cur_ord, cur_ord + lookahead)."""
+    lo, hi = ords.searchsorted([cur_ord, cur_ord + lookahead])
+    return lo, hi
+
+def _to_ordinal(current_date):
+    if isinstance(current_date, str):
+        current_date = pd.to_datetime(current_date)
+    elif isinstance(current_date, np.datetime64):
+        current_date = pd.Timestamp(current_date)
+    return current_date.toordinal()
 
 class FinancialCalendar:
     def __init__(self, data_path=None):
-        self.events = {}
         self.importance_levels = {'N': 0, 'L': 1, 'M': 2, 'H': 3}
+        # Eventi ordinati per giorno (ordinale date.toordinal) per ricerche per intervallo
+        self._ords = np.empty(0, dtype=np.int64)
+        self._dates = np.empty(0, dtype=object)
+        self._importances = np.empty(0, dtype=object)
+        self._descriptions = np.empty(0, dtype=object)
+        # Livello di importanza per evento (-1 se sconosciuto), calcolato una volta al caricamento
+        self._levels = np.empty(0, dtype=np.int8)
+        # Numero di eventi caricati, aggiornato da load_calendar
+        self.n_events = 0
         if data_path:
             self.load_calendar(data_path)
     
     def load_calendar(self, data_path):
         """Load financial events from simplified CSV (date, importance, description)."""
-        events_loaded = 0
-        
         try:
             # Leggi il file come testo
             with open(data_path, 'r') as file:
@@ -21,53 +44,53 @@ class FinancialCalendar:
             if lines and ('date' in lines[0].lower() or 'importance' in lines[0].lower()):
                 lines = lines[1:]
             
+            date_strs = []
+            importances = []
+            descriptions = []
+            
             for line in lines:
                 line = line.strip()
                 if not line:
                     continue
                 
                 # Formato semplificato: data,importanza,descrizione
-                try:
-                    parts = line.split(',', 2)  # Split solo sulle prime 2 virgole
-                    
-                    if len(parts) < 2:
-                        print(f"Skipping line with insufficient parts: {line}")
-                        continue
-                    
-                    date_str = parts[0].strip()
-                    importance = parts[1].strip()
-                    description = parts[2].strip() if len(parts) > 2 else ""
-                    
-                    # Parse della data
-                    try:
-                        date = pd.to_datetime(date_str).date()
-                    except Exception as e:
-                        print(f"Cannot parse date '{date_str}': {e}")
-                        continue
-                    
-                    # Crea e salva l'evento
-                    event = {
-                        'type': 'general',
-                        'importance': importance,
-                        'description': description
-                    }
-                    
-                    if date not in self.events:
-                        self.events[date] = []
-                    
-                    self.events[date].append(event)
-                    events_loaded += 1
+                parts = line.split(',', 2)  # Split solo sulle prime 2 virgole
                 
-                except Exception as e:
-                    print(f"Error processing line: {line}")
-                    print(f"Error details: {e}")
+                if len(parts) < 2:
+                    print(f"Skipping line with insufficient parts: {line}")
                     continue
+                
+                date_strs.append(parts[0].strip())
+                importances.append(parts[1].strip())
+                descriptions.append(parts[2].strip() if len(parts) > 2 else "")
+            
+            # Parse vettoriale di tutte le date in un'unica chiamata
+            dates = pd.to_datetime(pd.Series(date_strs, dtype=object), errors='coerce')
             
-            print(f"Successfully loaded {events_loaded} events from calendar")
+            valid = dates.notna().to_numpy()
+            for date_str in np.asarray(date_strs, dtype=object)[~valid]:
+                print(f"Cannot parse date '{date_str}'")
+            
+            # Ordinali giornalieri ordinati (sort stabile: mantiene l'ordine del file)
+            ords = dates[valid].to_numpy(dtype='datetime64[D]').astype(np.int64) + _EPOCH_ORDINAL
+            order = np.argsort(ords, kind='stable')
+            self._ords = ords[order]
+            self._dates = np.asarray([d.date() for d in dates[valid]], dtype=object)[order]
+            self._importances = np.asarray(importances, dtype=object)[valid][order]
+            self._descriptions = np.asarray(descriptions, dtype=object)[valid][order]
+            self._levels = np.asarray([self.importance_levels.get(imp, -1) for imp in self._importances],
+                                      dtype=np.int8)
+            
+            self.n_events = len(self._ords)
+            
+            print(f"Successfully loaded {self.n_events} events from calendar")
         
         except Exception as e:
             print(f"Error reading calendar file: {e}")
     
+    def __len__(self):
+        return self.n_events
+    
     def get_upcoming_events(self, current_date, lookahead=7, tickers=None):
         """
         Get important events in the next N days.
@@ -80,74 +103,74 @@ class FinancialCalendar:
         Returns:
         - List of upcoming events
         """
-        if isinstance(current_date, str):
-            current_date = pd.to_datetime(current_date).date()
-        elif isinstance(current_date, pd.Timestamp):
-            current_date = current_date.date()
-            
-        upcoming = []
+        cur_ord = _to_ordinal(current_date)
         
-        for i in range(lookahead):
-            check_date = current_date + timedelta(days=i)
-            if check_date in self.events:
-                for event in self.events[check_date]:
-                    upcoming.append({
-                        'days_ahead': i,
-                        'date': check_date,
-                        'type': event.get('type', 'general'),
-                        'importance': event['importance'],
-                        'importance_score': self.importance_levels.get(event['importance'], 0),
-                        'description': event.get('description', '')
-                    })
+        # Ricerca binaria della finestra [cur_ord, cur_ord + lookahead)
+        lo, hi = _event_window(self._ords, cur_ord, lookahead)
+        days_ahead = self._ords[lo:hi] - cur_ord
+        scores = np.maximum(self._levels[lo:hi], 0)
+        
+        upcoming = []
+        for i, date, importance, score, description in zip(
+                days_ahead.tolist(), self._dates[lo:hi], self._importances[lo:hi], scores.tolist(),
+                self._descriptions[lo:hi]):
+            upcoming.append({
+                'days_ahead': i,
+                'date': date,
+                'type': 'general',
+                'importance': importance,
+                'importance_score': score,
+                'description': description
+            })
         
         return upcoming
     
+    def count_upcoming_events(self, current_date, lookahead=7):
+        """
+        Count the events of the next N days by importance code ('H', 'M', ...).
+        Same window as get_upcoming_events, without building the per-event dicts.
+        """
+        lo, hi = _event_window(self._ords, _to_ordinal(current_date), lookahead)
+        return Counter(self._importances[lo:hi].tolist())
+    
     def get_event_features(self, current_date, tickers, lookahead=7):
         """
         Generate features for the ML model based on upcoming events.
         Returns a vector of features.
         """
-        upcoming = self.get_upcoming_events(current_date, lookahead)
-        
-        # Initialize features
-        features = {
-            'high_importance_count': 0,  # H
-            'medium_importance_count': 0,  # M
-            'low_importance_count': 0,  # L
-            'days_to_next_high': lookahead + 1,  # Default if none found
-            'days_to_next_medium': lookahead + 1,
-            'days_to_next_any': lookahead + 1,
-            'event_importance_weighted': 0  # Score ponderato
-        }
+        cur_ord = _to_ordinal(current_date)
+        lo, hi = _event_window(self._ords, cur_ord, lookahead)
+        days = self._ords[lo:hi] - cur_ord
         
-        # Calcola i conteggi e le distanze
-        for event in upcoming:
-            # Conteggi per importanza
-            importance = event['importance']
-            if importance == 'H':
-                features['high_importance_count'] += 1
-            elif importance == 'M':
-                features['medium_importance_count'] += 1
-            elif importance == 'L':
-                features['low_importance_count'] += 1
+        # Livelli interi precalcolati: niente dizionari intermedi ne' confronti tra stringhe
+        H, M, L, N = (self.importance_levels[k] for k in ('H', 'M', 'L', 'N'))
+        counts = [0, 0, 0, 0]
+        next_high = next_medium = next_any = lookahead + 1  # Default if none found
+        weighted = 0
+        for level, days_ahead in zip(self._levels[lo:hi].tolist(), days.tolist()):
+            if level >= 0:
+                counts[level] += 1
+            # Eventi ordinati per giorno: il primo trovato è il più vicino
+            if level == H and next_high > lookahead:
+                next_high = days_ahead
+            elif level == M and next_medium > lookahead:
+                next_medium = days_ahead
             # Ignoriamo gli eventi 'N' (festivities)
-            
-            # Giorni al prossimo evento
-            days_ahead = event['days_ahead']
-            if importance == 'H' and days_ahead < features['days_to_next_high']:
-                features['days_to_next_high'] = days_ahead
-            if importance == 'M' and days_ahead < features['days_to_next_medium']:
-                features['days_to_next_medium'] = days_ahead
-            if importance != 'N' and days_ahead < features['days_to_next_any']:
-                features['days_to_next_any'] = days_ahead
-                
+            if level != N and next_any > lookahead:
+                next_any = days_ahead
             # Score ponderato per importanza e vicinanza
-            importance_score = self.importance_levels.get(importance, 0)
-            proximity_weight = 1.0 / (days_ahead + 1)  # Più vicino = peso maggiore
-            features['event_importance_weighted'] += importance_score * proximity_weight
+            if level > 0:
+                weighted += level * (1.0 / (days_ahead + 1))  # Più vicino = peso maggiore
         
-        # Normalizza gli score
-        normalization_factor = max(lookahead, 1)
-        features['event_importance_weighted'] /= normalization_factor
-            
-        return features
\ No newline at end of file
+        features = {
+            'high_importance_count': counts[H],  # H
+            'medium_importance_count': counts[M],  # M
+            'low_importance_count': counts[L],  # L
+            'days_to_next_high': next_high,
+            'days_to_next_medium': next_medium,
+            'days_to_next_any': next_any,
+            # Normalizza gli score
+            'event_importance_weighted': weighted / max(lookahead, 1)
+        }
+        
+        return features
@@ -1,31 +1,68 @@
 # New file: market_regime.py
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from hmmlearn import hmm
 
+def _regime_features(prices):
+    """Rendimenti e rendimenti assoluti lungo l'ultimo asse: [..., W] prezzi -> [..., W-1, 2] feature per l'HMM."""
+    returns = np.diff(prices, axis=-1) / prices[..., :-1]
+    return np.stack([returns, np.abs(returns)], axis=-1)
+
 class MarketRegimeDetector:
     def __init__(self, window_size=60, n_regimes=3):
         self.window_size = window_size
         self.n_regimes = n_regimes
         self.hmm_model = hmm.GaussianHMM(n_components=n_regimes, covariance_type="full")
-        
+        # Il modello viene stimato una volta per episodio e poi usato solo in predizione
+        self.fitted = False
+
+    def reset(self):
+        """Forget the current fit, so the next detection refits the HMM (call once per episode)."""
+        self.fitted = False
+
     def detect_regime(self, price_history):
         """Detect the current market regime using HMM."""
         if len(price_history) < self.window_size:
             return 0  # Default regime
-            
-        # Extract features from recent price history
-        returns = np.diff(price_history[-self.window_size:]) / price_history[-self.window_size:-1]
-        volatility = np.std(returns) * np.sqrt(252)  # Annualized volatility
-        
-        # Using returns and volatility as features
-        X = np.column_stack([returns, np.abs(returns)])
-        
+
+        # Extract features from recent price history (returns and absolute returns)
+        X = _regime_features(np.asarray(price_history[-self.window_size:], dtype=float))
+
         if len(X) < self.window_size - 1:
             return 0
-            
-        # Fit the model if we have enough data
-        self.hmm_model.fit(X)
-        
+
+        # Fit the model only once per episode
+        if not self.fitted:
+            self.hmm_model.fit(X)
+            self.fitted = True
+
         # Predict the current regime
         current_regime = self.hmm_model.predict(X)[-1]
-        return current_regime
\ No newline at end of file
+        return current_regime
+
+    def detect_regime_series(self, prices):
+        """
+        Regime at the end of every window of window_size prices in a series, like calling
+        detect_regime on each window. Returns are computed once on the whole series and then
+        windowed as strided views, and all windows are decoded by a single HMM predict call.
+        """
+        prices = np.asarray(prices, dtype=float)
+        if len(prices) < self.window_size:
+            return np.zeros(0, dtype=int)
+        
+        features = _regime_features(prices)  # [T-1, 2]
+        X = sliding_window_view(features, self.window_size - 1, axis=0).transpose(0, 2, 1)  # [n, W-1, 2]
+        return self._predict_windows(X)
+
+    def _predict_windows(self, X):
+        """Decode a [n, W-1, 2] stack of window features in one HMM call; last state of each window."""
+        n, length = X.shape[:2]
+        
+        # Fit the model only once per episode (sulla prima finestra, come detect_regime)
+        if not self.fitted:
+            self.hmm_model.fit(X[0])
+            self.fitted = True
+        
+        # Una sequenza per finestra: lengths separa le finestre concatenate
+        states = self.hmm_model.predict(X.reshape(n * length, 2), lengths=[length] * n)
+        return states.reshape(n, length)[:, -1]
@@ -1,6 +1,8 @@
 import os
 from time import sleep
 from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 import numpy as np
 import torch
@@ -19,6 +21,29 @@ from portfolio_models import PortfolioCritic, EnhancedPortfolioActor, AssetEncod
 # Definizione di un namedtuple per le transizioni
 Transition = namedtuple("Transition", ("state", "action", "reward", "next_state", "dones"))
 
+def _cpu_copy(obj):
+    """Copia su CPU, staccata dai parametri in training, di tensori anche annidati in dict/list (per salvataggi asincroni)."""
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        copied = type(obj)((k, _cpu_copy(v)) for k, v in obj.items())
+        if hasattr(obj, "_metadata"):
+            copied._metadata = obj._metadata  # Versioni dei moduli negli state_dict
+        return copied
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_cpu_copy(v) for v in obj)
+    return obj
+
+def _drain_saves(pending_saves, wait=False):
+    """Propaga gli errori dei salvataggi asincroni conclusi (o di tutti, con wait) e li toglie dalla lista."""
+    still_pending = []
+    for future in pending_saves:
+        if wait or future.done():
+            future.result()
+        else:
+            still_pending.append(future)
+    pending_saves[:] = still_pending
+
 # Parametri globali
 GAMMA = 0.99                 
 TAU_ACTOR = 1e-1             
@@ -52,6 +77,9 @@ class MultiAssetOUNoise:
     Ornstein-Uhlenbeck process for generating temporally correlated exploration noise
     for multiple assets simultaneously.
     """
+    # True per i processi che adattano sigma alla performance (vedi AdaptiveExploration)
+    adaptive = False
+    
     def __init__(self, action_size, mu=0.0, theta=0.1, sigma=0.2):
         self.action_size = action_size
         self.mu = mu * np.ones(action_size)
@@ -84,6 +112,8 @@ class MultiAssetOUNoise:
         return noise
 
 class AdaptiveExploration(MultiAssetOUNoise):
+    adaptive = True
+    
     def __init__(self, action_size, mu=0.0, theta=0.1, sigma=0.2, min_sigma=0.05):
         super().__init__(action_size, mu, theta, sigma)
         self.min_sigma = min_sigma
@@ -113,7 +143,10 @@ class PortfolioAgent:
         theta=0.1,
         sigma=0.2,
         use_enhanced_actor=False,
-        use_batch_norm=True
+        use_batch_norm=True,
+        use_checkpoint=False,
+        use_amp=True,
+        compile_models=False
     ):
         assert 0 <= gamma <= 1, "Gamma must be in [0,1]"
         assert memory_type in ["uniform", "prioritized"], "Invalid memory type"
@@ -125,10 +158,19 @@ class PortfolioAgent:
         self.epsilon = epsilon
         self.use_enhanced_actor = use_enhanced_actor
         self.use_batch_norm = use_batch_norm
+        self.use_checkpoint = use_checkpoint
+        # Forward compilati con torch.compile(mode='reduce-overhead'): CUDA graph su GPU
+        self.compile_models = compile_models
 
         # Device management: utilizza GPU se disponibile
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+        # Mixed precision BF16 (non richiede GradScaler) e TF32 per le matmul su GPU
+        self.use_amp = use_amp and self.device.type == "cuda" and torch.cuda.is_bf16_supported()
+        if self.device.type == "cuda":
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+
         if memory_type == "uniform":
             self.memory = Memory(max_size=max_size)
         elif memory_type == "prioritized":
@@ -148,6 +190,9 @@ class PortfolioAgent:
         self.critic_local = None
         self.critic_target = None
 
+        # Buffer di staging per lo stato in act(): allocato una volta (pinned su CUDA) e riscritto in place
+        self._state_staging = None
+
     def reset(self):
         self.noise.reset()
 
@@ -185,11 +230,15 @@ class PortfolioAgent:
         return checkpoint['episode'], checkpoint['metrics']
 
     def step(self, state, action, reward, next_state, done, pretrain=False):
-        state_mb = torch.tensor([state], dtype=torch.float).to(self.device)
-        action_mb = torch.tensor([action], dtype=torch.float).to(self.device)
-        reward_mb = torch.tensor([[reward]], dtype=torch.float).to(self.device)
-        next_state_mb = torch.tensor([next_state], dtype=torch.float).to(self.device)
-        not_done_mb = torch.tensor([[not done]], dtype=torch.float).to(self.device)
+        state, action, next_state = np.ravel(state), np.ravel(action), np.ravel(next_state)
+        # Transizione impacchettata in un'unica riga float32: una sola copia host->device
+        # (da memoria pinned e asincrona su CUDA) invece di cinque tensori separati
+        row = torch.from_numpy(np.concatenate((state, action, [reward], next_state, [not done])).astype(np.float32))
+        if self.device.type == "cuda":
+            row = row.pin_memory()
+        row = row.to(self.device, non_blocking=True).unsqueeze(0)
+        state_mb, action_mb, reward_mb, next_state_mb, not_done_mb = row.split(
+            [state.size, action.size, 1, next_state.size, 1], dim=1)
         if self.memory_type == "uniform":
             self.memory.add((state_mb, action_mb, reward_mb, next_state_mb, not_done_mb))
         elif self.memory_type == "prioritized":
@@ -198,7 +247,10 @@ class PortfolioAgent:
 
     def act(self, state, noise=True, explore_probability=1.0, truncate=False, max_pos=2.0):
         positions = state[-self.num_assets:]
-        state_tensor = torch.from_numpy(state).float().unsqueeze(0).to(self.device)
+        if self._state_staging is None or self._state_staging.shape[1] != state.size:
+            self._state_staging = torch.empty((1, state.size), pin_memory=self.device.type == "cuda")
+        self._state_staging[0].copy_(torch.from_numpy(state))
+        state_tensor = self._state_staging.to(self.device, non_blocking=True)
         self.actor_local.eval()
         with torch.no_grad():
             actions = self.actor_local(state_tensor).cpu().data.numpy()[0]
@@ -208,6 +260,9 @@ class PortfolioAgent:
             actions += explore_probability * noise_sample
         return actions
 
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.use_amp)
+
     def soft_update(self, local_model, target_model, tau):
         for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
             target_param.data.copy_(tau * local_param.data + (1.0 - tau) * target_param.data)
@@ -228,8 +283,17 @@ class PortfolioAgent:
                 if done:
                     env.reset()
 
-    def train(
+    def train(self, *args, **kwargs):
+        """
+        Train the agent (arguments as in _train). The async checkpoint executor and a SummaryWriter
+        created by train itself are shut down in one cleanup, also when training raises.
+        """
+        with ExitStack() as cleanup:
+            return self._train(cleanup, *args, **kwargs)
+
+    def _train(
         self,
+        cleanup,
         env,
         total_episodes=100,
         tau_actor=TAU_ACTOR,
@@ -259,15 +323,30 @@ class PortfolioAgent:
         checkpoint_path=None,
         checkpoint_freq=10,
         resume_from=None,
-        early_stop_patience=20   # Numero di episodi senza miglioramento per early stopping
+        early_stop_patience=20,  # Numero di episodi senza miglioramento per early stopping
+        async_checkpoint=False,  # Salvataggi di pesi e checkpoint su un thread separato
+        writer=None,             # SummaryWriter condiviso (chiuso dal chiamante); se None ne crea uno
+        episode_callback=None    # Chiamata a fine episodio come callback(env, agent, episode, i, writer)
     ):
         self.last_checkpoint_episode = -1
+        # Con async_checkpoint i torch.save girano su un solo thread in background, su copie CPU
+        # degli state_dict: il training prosegue mentre i file vengono scritti
+        if async_checkpoint:
+            save_executor = cleanup.enter_context(ThreadPoolExecutor(max_workers=1))
+            pending_saves = []
+            def save(obj, path):
+                pending_saves.append(save_executor.submit(torch.save, _cpu_copy(obj), path))
+        else:
+            save = torch.save
         if not os.path.isdir(weights):
             os.makedirs(weights, exist_ok=True)
         if checkpoint_path is None:
             checkpoint_path = weights
 
-        writer = SummaryWriter(log_dir=tensordir)
+        own_writer = writer is None
+        if own_writer:
+            writer = SummaryWriter(log_dir=tensordir)
+            cleanup.callback(writer.close)
 
         checkpoint = None
         asset_encoder_dim = None
@@ -313,7 +392,9 @@ class PortfolioAgent:
             encoding_size=encoding_size,
             use_attention=True,
             attention_size=attention_dim,
-            encoder_output_size=encoder_output_size
+            encoder_output_size=encoder_output_size,
+            use_checkpoint=self.use_checkpoint,
+            compile_forward=self.compile_models
         )
 
         if self.use_enhanced_actor and features_per_asset > 0:
@@ -333,7 +414,9 @@ class PortfolioAgent:
                 encoding_size=encoding_size,
                 use_attention=True,
                 attention_size=attention_dim,
-                encoder_output_size=encoder_output_size
+                encoder_output_size=encoder_output_size,
+                use_checkpoint=self.use_checkpoint,
+                compile_forward=self.compile_models
             )
             self.actor_target = EnhancedPortfolioActor(
                 env.state_size, 
@@ -342,7 +425,8 @@ class PortfolioAgent:
                 fc1_units=fc1_units_actor,
                 fc2_units=fc2_units_actor,
                 encoding_size=encoding_size,
-                use_attention=True
+                use_attention=True,
+                compile_forward=self.compile_models
             )
         else:
             pass
@@ -353,7 +437,8 @@ class PortfolioAgent:
             fcs1_units=fc1_units_critic, 
             fc2_units=fc2_units_critic,
             fc3_units=fc3_units_critic,
-            use_batch_norm=self.use_batch_norm
+            use_batch_norm=self.use_batch_norm,
+            compile_forward=self.compile_models
         )
         self.critic_target = PortfolioCritic(
             env.state_size, 
@@ -361,7 +446,8 @@ class PortfolioAgent:
             fcs1_units=fc1_units_critic, 
             fc2_units=fc2_units_critic,
             fc3_units=fc3_units_critic,
-            use_batch_norm=self.use_batch_norm
+            use_batch_norm=self.use_batch_norm,
+            compile_forward=self.compile_models
         )
         
         actor_optimizer = optim.Adam(self.actor_local.parameters(), lr=lr_actor, weight_decay=weight_decay_actor)
@@ -372,7 +458,7 @@ class PortfolioAgent:
 
         if not resume_from:
             model_file = os.path.join(weights, "portfolio_actor_initial.pth")
-            torch.save(self.actor_local.state_dict(), model_file)
+            save(self.actor_local.state_dict(), model_file)
 
         mean_rewards = deque(maxlen=10)
         cum_rewards = []
@@ -513,11 +599,13 @@ class PortfolioAgent:
                         rewards_mb = torch.cat(batch.reward)
                         next_states_mb = torch.cat(batch.next_state)
                         dones_mb = torch.cat(batch.dones)
-                    actions_next = self.actor_target(next_states_mb)
-                    Q_targets_next = self.critic_target(next_states_mb, actions_next)
+                    with torch.no_grad(), self.autocast():
+                        actions_next = self.actor_target(next_states_mb)
+                        Q_targets_next = self.critic_target(next_states_mb, actions_next).float()
                     Q_targets = rewards_mb + (self.gamma * Q_targets_next * dones_mb)
-                    Q_expected = self.critic_local(states_mb, actions_mb)
-                    td_errors = F.l1_loss(Q_expected, Q_targets, reduction="none")
+                    with self.autocast():
+                        Q_expected = self.critic_local(states_mb, actions_mb)
+                    td_errors = F.l1_loss(Q_expected.float(), Q_targets, reduction="none")
                     if self.memory_type == "prioritized":
                         sum_priorities = self.memory.sum_priorities()
                         probabilities = (self.memory.retrieve_priorities(indices) / sum_priorities).reshape((-1, 1))
@@ -535,8 +623,9 @@ class PortfolioAgent:
                     torch.nn.utils.clip_grad_norm_(self.critic_local.parameters(), clip_grad_norm)
                     critic_optimizer.step()
                     critic_lr_scheduler.step()
-                    actions_pred = self.actor_local(states_mb)
-                    actor_loss = -self.critic_local(states_mb, actions_pred).mean()
+                    with self.autocast():
+                        actions_pred = self.actor_local(states_mb)
+                        actor_loss = -self.critic_local(states_mb, actions_pred).float().mean()
                     actor_losses.append(actor_loss.data.item())
                     actor_optimizer.zero_grad()
                     actor_loss.backward()
@@ -546,11 +635,15 @@ class PortfolioAgent:
                     self.soft_update(self.critic_local, self.critic_target, tau_critic)
                     self.soft_update(self.actor_local, self.actor_target, tau_actor)
 
+            if episode_complete and episode_callback is not None:
+                # Metriche aggiuntive del chiamante (es. EnhancedTrainingMonitor) sull'episodio appena concluso
+                episode_callback(env, self, episode, i, writer)
+
             if episode_complete and ((episode % freq) == 0 or episode == total_episodes - 1):
                 actor_file = os.path.join(weights, f"portfolio_actor_{episode}.pth")
                 critic_file = os.path.join(weights, f"portfolio_critic_{episode}.pth")
-                torch.save(self.actor_local.state_dict(), actor_file)
-                torch.save(self.critic_local.state_dict(), critic_file)
+                save(self.actor_local.state_dict(), actor_file)
+                save(self.critic_local.state_dict(), critic_file)
                 if episode != self.last_checkpoint_episode and ((episode % checkpoint_freq == 0) or episode == total_episodes - 1):
                     self.last_checkpoint_episode = episode
                     checkpoint_file = os.path.join(checkpoint_path, f"checkpoint_ep{episode}.pt")
@@ -572,11 +665,18 @@ class PortfolioAgent:
                         'critic_target_state_dict': self.critic_target.state_dict(),
                         'metrics': metrics
                     }
-                    torch.save(checkpoint, checkpoint_file)
+                    save(checkpoint, checkpoint_file)
                     print(f"Checkpoint salvato: {checkpoint_file}")
 
+            if async_checkpoint:
+                # Un errore di scrittura interrompe subito il training invece di emergere solo alla fine
+                _drain_saves(pending_saves)
+
+        if async_checkpoint:
+            # Attende la scrittura di tutti i file (e propaga eventuali errori) prima di restituire
+            _drain_saves(pending_saves, wait=True)
+
         writer.export_scalars_to_json("./portfolio_scalars.json")
-        writer.close()
         
         return {
             'final_rewards': mean_rewards,
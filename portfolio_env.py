@@ -3,6 +3,28 @@ import json
 import pandas as pd
 from utils import build_ou_process
 
+def _simple_returns(values):
+    """Rendimenti semplici di una serie di valori, con una sola conversione ad array."""
+    values = np.asarray(values, dtype=float)
+    return np.diff(values) / values[:-1]
+
+def _cvar(returns, alpha):
+    """
+    Media della coda sinistra (frazione alpha) dei rendimenti lungo l'ultimo asse.
+    Con un array [episodi, T] calcola il CVaR di tutti gli episodi in un'unica chiamata.
+    """
+    returns = np.asarray(returns)
+    k = int(alpha * returns.shape[-1])
+    if k == 0:
+        return np.nan if returns.ndim == 1 else np.full(returns.shape[:-1], np.nan)
+    # Selezione parziale O(n) dei k rendimenti peggiori invece dell'ordinamento completo
+    return np.mean(np.partition(returns, k - 1, axis=-1)[..., :k], axis=-1)
+
+def _herfindahl_diversification(exposures):
+    """1 - indice di Herfindahl dei pesi (esposizioni in valore assoluto)."""
+    weights = exposures / (np.sum(exposures) + 1e-8)  # Evita divisione per zero
+    return 1.0 - np.dot(weights, weights)
+
 class PortfolioEnvironment:
     """
     Ambiente per l'ottimizzazione di un portafoglio multi-asset.
@@ -104,13 +126,20 @@ class PortfolioEnvironment:
         # Storia e tracking
         self.position_history = []   # Storia delle posizioni
         self.action_history = []     # Storia delle azioni
-        self.price_history = {ticker: [] for ticker in tickers}  # Storia dei prezzi per ticker
+        # Storia dei prezzi per asset in un buffer NumPy [num_assets, capacità] (vedi get_price_window)
+        self._price_buf = np.zeros((self.num_assets, max([len(df) for df in (dfs or {}).values()], default=0) + 1))
+        self._price_len = [0] * self.num_assets
         self.returns_history = {ticker: [] for ticker in tickers}  # Storia dei rendimenti
         self.portfolio_values_history = []  # Storia dei valori del portafoglio
         self.cash_history = []       # Storia del cash disponibile
         
         # Gestione dei dati
         self.dfs = dfs if dfs is not None else {}
+        # Date (dal primo ticker, i frame sono allineati) estratte una volta sola:
+        # evitano la scansione delle colonne e list(...)[0]['date'].iloc[...] a ogni step
+        self._date_array = None
+        if self.dfs and all('date' in df.columns for df in self.dfs.values()):
+            self._date_array = next(iter(self.dfs.values()))['date'].to_numpy()
         
         # Segnali simulati se non ci sono dati reali
         if not self.dfs:
@@ -167,13 +196,30 @@ class PortfolioEnvironment:
         # Dimensione dello stato per asset e per il portfolio complessivo
         self.state_size_per_asset = len(self.norm_columns)
         self.action_size = self.num_assets  # Un'azione per ogni asset
-        self.state_size = (self.state_size_per_asset * self.num_assets) + self.num_assets + 5
+        self.state_size = (self.state_size_per_asset * self.num_assets) + self.num_assets + 5 + 6
         # ^ feature di tutti gli asset + posizioni attuali + 5 metriche di portfolio
+        #   + 6 feature del calendario (sempre presenti in get_state, a zero senza calendario)
         
         # Inizializza raw_state per ogni ticker
         for ticker in self.tickers:
             self.raw_states[ticker] = {col: 0.0 for col in self.norm_columns}
         
+        # Matrici [T, n_feature] e vettori di prezzo estratti una volta dai DataFrame:
+        # a ogni step si legge una riga NumPy invece di df.iloc[...].to_dict()
+        self._feature_arrays = {}
+        self._price_arrays = {}
+        for ticker in self.tickers:
+            if ticker in self.dfs:
+                df = self.dfs[ticker]
+                missing = [col for col in self.norm_columns if col not in df.columns]
+                if missing:
+                    raise ValueError(f"Mancano le seguenti colonne nel DataFrame di {ticker}: {missing}")
+                self._feature_arrays[ticker] = df[list(self.norm_columns)].to_numpy()
+                if "adjClose" in df.columns:
+                    self._price_arrays[ticker] = df["adjClose"].to_numpy()
+                elif "close" in df.columns:
+                    self._price_arrays[ticker] = df["close"].to_numpy()
+        
         # Flag episodio terminato
         self.done = False
 
@@ -209,10 +255,8 @@ class PortfolioEnvironment:
         if len(self.portfolio_values_history) < 30:
             return 0.0
             
-        returns = np.diff(self.portfolio_values_history) / self.portfolio_values_history[:-1]
-        sorted_returns = np.sort(returns)
-        cutoff_index = int((1 - confidence_level) * len(sorted_returns))
-        return np.mean(sorted_returns[:cutoff_index])
+        returns = _simple_returns(self.portfolio_values_history)
+        return _cvar(returns, 1 - confidence_level)
     
     # Add to portfolio_env.py
     def calculate_cross_asset_features(self):
@@ -248,29 +292,40 @@ class PortfolioEnvironment:
         if not self.dfs:
             return
         
-        for ticker in self.tickers:
-            if ticker in self.dfs:
-                df = self.dfs[ticker]
-                if current_index < len(df):
-                    # Estrai la riga corrente per questo ticker
-                    row = df.iloc[current_index].to_dict()
+        for asset_index, ticker in enumerate(self.tickers):
+            if ticker in self._feature_arrays:
+                features = self._feature_arrays[ticker]
+                if current_index < len(features):
+                    # Aggiorna lo stato grezzo dalla riga corrente (colonne gia' validate in __init__)
+                    self.raw_states[ticker] = dict(zip(self.norm_columns, features[current_index].tolist()))
                     
-                    # Verifica che tutte le colonne necessarie siano presenti
-                    missing = [col for col in self.norm_columns if col not in row]
-                    if missing:
-                        raise ValueError(f"Mancano le seguenti colonne nel DataFrame di {ticker}: {missing}")
-                    
-                    # Aggiorna lo stato grezzo
-                    for col in self.norm_columns:
-                        self.raw_states[ticker][col] = row[col]
-                    
-                    # Aggiorna il prezzo corrente per questo asset
-                    if "adjClose" in row:
-                        self.prices[self.tickers.index(ticker)] = row["adjClose"]
-                        self.price_history[ticker].append(row["adjClose"])
-                    elif "close" in row:
-                        self.prices[self.tickers.index(ticker)] = row["close"]
-                        self.price_history[ticker].append(row["close"])
+                    # Aggiorna il prezzo corrente per questo asset (adjClose, in alternativa close)
+                    if ticker in self._price_arrays:
+                        price = self._price_arrays[ticker][current_index]
+                        self.prices[asset_index] = price
+                        self._append_price(asset_index, price)
+    
+    def _append_price(self, asset_index, price):
+        n = self._price_len[asset_index]
+        if n == self._price_buf.shape[1]:
+            # Capacità esaurita: raddoppia il buffer (caso raro, dimensionato sui DataFrame)
+            self._price_buf = np.concatenate((self._price_buf, np.zeros_like(self._price_buf)), axis=1)
+        self._price_buf[asset_index, n] = price
+        self._price_len[asset_index] = n + 1
+    
+    def get_price_window(self, asset_index, size=None):
+        """
+        Restituisce gli ultimi `size` prezzi (tutti se None) dell'asset come vista contigua
+        sul buffer interno, senza copie. La vista va copiata se deve sopravvivere allo step successivo.
+        """
+        n = self._price_len[asset_index]
+        start = 0 if size is None else max(0, n - size)
+        return self._price_buf[asset_index, start:n]
+    
+    @property
+    def price_history(self):
+        """Storia dei prezzi per ticker (viste sul buffer interno)."""
+        return {ticker: self.get_price_window(i) for i, ticker in enumerate(self.tickers)}
     
     def reset(self, random_state=None, noise_seed=None, start_index=None):
         """
@@ -288,8 +343,8 @@ class PortfolioEnvironment:
         self.portfolio_values_history = []
         self.cash_history = []
         
+        self._price_len = [0] * self.num_assets
         for ticker in self.tickers:
-            self.price_history[ticker] = []
             self.returns_history[ticker] = []
         
         # Gestione dei dati simulati o reali
@@ -358,7 +413,7 @@ class PortfolioEnvironment:
             return np.zeros(5)  # 5 metriche portfolio
         
         # 1. Calcola i rendimenti del portafoglio
-        portfolio_returns = np.diff(self.portfolio_values_history) / self.portfolio_values_history[:-1]
+        portfolio_returns = _simple_returns(self.portfolio_values_history)
         
         # 2. Calcola volatilità del portafoglio (annualizzata)
         if len(portfolio_returns) > 1:
@@ -459,8 +514,8 @@ class PortfolioEnvironment:
         # Dopo aver aggiunto posizioni e metriche di portafoglio
         if self.calendar is not None:
             current_date = None
-            if all('date' in df.columns for df in self.dfs.values()):
-                current_date = list(self.dfs.values())[0]['date'].iloc[self.current_index]
+            if self._date_array is not None:
+                current_date = self._date_array[self.current_index]
                 
             if current_date is not None:
                 # Ottieni feature dal calendario
@@ -541,20 +596,11 @@ class PortfolioEnvironment:
         if self.diversification_bonus_factor == 0:
             return 0
         
-        # Normalizza le posizioni (usa valori assoluti per considerare esposizione)
-        abs_positions = np.abs(self.positions * self.prices)
-        total_exposure = np.sum(abs_positions) + 1e-8  # Evita divisione per zero
+        # Calcola la diversificazione (1 - indice Herfindahl) sulle esposizioni in valore assoluto
+        diversification = _herfindahl_diversification(np.abs(self.positions * self.prices))
         
-        # Calcola la diversificazione (1 - indice Herfindahl)
-        if total_exposure > 0:
-            weights = abs_positions / total_exposure
-            herfindahl_index = np.sum(weights ** 2)
-            diversification = 1.0 - herfindahl_index
-            
-            # Scala in base al fattore di diversificazione
-            return diversification * self.diversification_bonus_factor
-            
-        return 0
+        # Scala in base al fattore di diversificazione
+        return diversification * self.diversification_bonus_factor
     
     def calculate_risk(self):
         """
@@ -564,7 +610,7 @@ class PortfolioEnvironment:
             return 0
         
         # Calcola i rendimenti
-        returns = np.diff(self.portfolio_values_history) / self.portfolio_values_history[:-1]
+        returns = _simple_returns(self.portfolio_values_history)
         
         if len(returns) < 2:
             return 0
@@ -606,7 +652,8 @@ class PortfolioEnvironment:
         prev_positions = self.positions.copy()
         prev_prices = self.prices.copy()
 
-        self.position_history.append(prev_positions.copy())
+        # prev_positions e' gia' una copia e non viene modificata nello step: nessuna seconda copia
+        self.position_history.append(prev_positions)
         self.action_history.append(actions.copy())
 
         next_positions_unclipped = prev_positions + actions
@@ -632,8 +679,8 @@ class PortfolioEnvironment:
             return 0.0
 
         self.update_raw_states(self.current_index)
-        if all('date' in df.columns for df in self.dfs.values()):
-            current_date = pd.to_datetime(list(self.dfs.values())[0]['date'].iloc[self.current_index])
+        if self._date_array is not None:
+            current_date = pd.Timestamp(self._date_array[self.current_index])
             if (current_date.year, current_date.month) != self.current_month:
                 self.current_month = (current_date.year, current_date.month)
                 self.trade_count = 0
@@ -711,8 +758,8 @@ class PortfolioEnvironment:
         # Dopo aver calcolato la ricompensa base
         if self.calendar is not None:
             current_date = None
-            if all('date' in df.columns for df in self.dfs.values()):
-                current_date = list(self.dfs.values())[0]['date'].iloc[self.current_index]
+            if self._date_array is not None:
+                current_date = self._date_array[self.current_index]
                 
             if current_date is not None:
                 # Ottieni eventi imminenti
@@ -871,7 +918,7 @@ class PortfolioEnvironment:
             }
         
         # Calcola rendimenti e metriche
-        portfolio_returns = np.diff(self.portfolio_values_history) / self.portfolio_values_history[:-1]
+        portfolio_returns = _simple_returns(self.portfolio_values_history)
         
         # Rendimento totale
         initial_value = self.portfolio_values_history[0]
@@ -1,11 +1,11 @@
-import numpy as np
+import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 def hidden_init(layer):
-    fan_in = layer.weight.data.size()[1]
-    lim = 1.0 / np.sqrt(fan_in)
+    lim = 1.0 / math.sqrt(layer.in_features)
     return (-lim, lim)
 
 # Add to portfolio_models.py
@@ -28,9 +28,9 @@ class DistributionalCritic(nn.Module):
         self.reset_parameters()
         
     def reset_parameters(self):
-        self.fc1.weight.data.uniform_(*hidden_init(self.fc1))
-        self.fc2.weight.data.uniform_(*hidden_init(self.fc2))
-        self.fc3.weight.data.uniform_(-3e-4, 3e-4)
+        nn.init.uniform_(self.fc1.weight, *hidden_init(self.fc1))
+        nn.init.uniform_(self.fc2.weight, *hidden_init(self.fc2))
+        nn.init.uniform_(self.fc3.weight, -3e-4, 3e-4)
     
     def forward(self, state, action):
         """Returns distribution over possible Q-values"""
@@ -48,9 +48,12 @@ class DistributionalCritic(nn.Module):
         return expected_value
 
 class PortfolioCritic(nn.Module):
-    def __init__(self, state_size, action_size, seed=0, fcs1_units=256, fc2_units=128, fc3_units=64, use_batch_norm=True):
+    def __init__(self, state_size, action_size, seed=0, fcs1_units=256, fc2_units=128, fc3_units=64, use_batch_norm=True,
+                 compile_forward=False):
         super(PortfolioCritic, self).__init__()
         self.seed = torch.manual_seed(seed)
+        # use_batch_norm mantiene il nome storico ma attiva LayerNorm: niente statistiche di batch,
+        # funziona anche con batch di 1 transizione ed è identico in train() ed eval()
         self.use_batch_norm = use_batch_norm
         
         self.fcs1 = nn.Linear(state_size + action_size, fcs1_units)
@@ -59,34 +62,67 @@ class PortfolioCritic(nn.Module):
         self.fc4 = nn.Linear(fc3_units, 1)
         
         if use_batch_norm:
-            self.bn1 = nn.BatchNorm1d(fcs1_units)
-            self.bn2 = nn.BatchNorm1d(fc2_units)
-            self.bn3 = nn.BatchNorm1d(fc3_units)
+            self.ln1 = nn.LayerNorm(fcs1_units)
+            self.ln2 = nn.LayerNorm(fc2_units)
+            self.ln3 = nn.LayerNorm(fc3_units)
+        
+        # Buffer riutilizzato per la concatenazione (state, action) fuori da autograd
+        self._cat_buf = None
         
         self.reset_parameters()
+        
+        # Opzionale: TorchInductor fonde ogni tripletta Linear -> norm -> ReLU in un unico kernel;
+        # 'reduce-overhead' cattura inoltre il forward (shape statiche) in un CUDA graph su GPU
+        self._compiled_forward = None
+        if compile_forward:
+            self._compiled_forward = torch.compile(self._raw_forward, mode='reduce-overhead', dynamic=False)
     
     def reset_parameters(self):
-        self.fcs1.weight.data.uniform_(*hidden_init(self.fcs1))
-        self.fcs1.bias.data.fill_(0)
-        self.fc2.weight.data.uniform_(*hidden_init(self.fc2))
-        self.fc2.bias.data.fill_(0)
-        self.fc3.weight.data.uniform_(*hidden_init(self.fc3))
-        self.fc3.bias.data.fill_(0)
-        self.fc4.weight.data.uniform_(-3e-4, 3e-4)
-        self.fc4.bias.data.fill_(0)
+        nn.init.uniform_(self.fcs1.weight, *hidden_init(self.fcs1))
+        nn.init.zeros_(self.fcs1.bias)
+        nn.init.uniform_(self.fc2.weight, *hidden_init(self.fc2))
+        nn.init.zeros_(self.fc2.bias)
+        nn.init.uniform_(self.fc3.weight, *hidden_init(self.fc3))
+        nn.init.zeros_(self.fc3.bias)
+        nn.init.uniform_(self.fc4.weight, -3e-4, 3e-4)
+        nn.init.zeros_(self.fc4.bias)
+    
+    def _concat_inputs(self, state, action):
+        if torch.is_grad_enabled():
+            # Con autograd attivo un buffer condiviso verrebbe sovrascritto prima del backward
+            return torch.cat((state, action), dim=1)
+        shape = (state.size(0), state.size(1) + action.size(1))
+        buf = self._cat_buf
+        if (buf is None or buf.shape != shape or buf.device != state.device or buf.dtype != state.dtype
+                or buf.is_inference() != torch.is_inference_mode_enabled()):
+            buf = self._cat_buf = state.new_empty(shape)
+        return torch.cat((state, action), dim=1, out=buf)
     
     def forward(self, state, action):
-        x = torch.cat((state, action), dim=1)
+        if self._compiled_forward is not None:
+            return self._compiled_forward(state, action)
+        return self._raw_forward(state, action)
+    
+    def _raw_forward(self, state, action):
+        x = self._concat_inputs(state, action)
         if self.use_batch_norm:
-            x = F.relu(self.bn1(self.fcs1(x)))
-            x = F.relu(self.bn2(self.fc2(x)))
-            x = F.relu(self.bn3(self.fc3(x)))
+            x = F.relu(self.ln1(self.fcs1(x)))
+            x = F.relu(self.ln2(self.fc2(x)))
+            x = F.relu(self.ln3(self.fc3(x)))
         else:
             x = F.relu(self.fcs1(x))
             x = F.relu(self.fc2(x))
             x = F.relu(self.fc3(x))
         return self.fc4(x)
 
+def _attention_context(assets, query, value_weight, value_bias):
+    """Contesto [B, E] dell'attention a query singola come sequenza di einsum."""
+    weights = torch.einsum('bne,e->bn', assets, query).softmax(dim=1)
+    # I pesi sommano a 1: la proiezione value si applica una volta al contesto pesato
+    # invece che a ciascuno degli N asset
+    pooled = torch.einsum('bn,bne->be', weights, assets)
+    return torch.einsum('be,fe->bf', pooled, value_weight) + value_bias
+
 class AssetEncoder(nn.Module):
     def __init__(self, features_per_asset, encoding_size=16, seed=0, output_size=None):
         super(AssetEncoder, self).__init__()
@@ -97,166 +133,157 @@ class AssetEncoder(nn.Module):
         
         self.fc1 = nn.Linear(features_per_asset, 32)
         self.fc2 = nn.Linear(32, self.output_size)
-        self.first_forward_done = False
         self.reset_parameters()
     
     def reset_parameters(self):
-        self.fc1.weight.data.uniform_(*hidden_init(self.fc1))
-        self.fc1.bias.data.fill_(0)
-        self.fc2.weight.data.uniform_(*hidden_init(self.fc2))
-        self.fc2.bias.data.fill_(0)
+        nn.init.uniform_(self.fc1.weight, *hidden_init(self.fc1))
+        nn.init.zeros_(self.fc1.bias)
+        nn.init.uniform_(self.fc2.weight, *hidden_init(self.fc2))
+        nn.init.zeros_(self.fc2.bias)
     
     def forward(self, state, num_assets):
         batch_size = state.size(0)
         total_features = state.size(1)
         asset_features_total = num_assets * self.features_per_asset
         
-        if not self.first_forward_done:
-            # Sostituisco i print di debug con un eventuale logging, se necessario
-            # E.g., logging.debug(f"AssetEncoder - Primo forward: state shape {state.shape}")
-            self.first_forward_done = True
+        assert total_features >= asset_features_total, \
+            f"Stato di {total_features} feature, attese almeno {asset_features_total}"
         
-        if total_features < asset_features_total:
-            padding_needed = asset_features_total - total_features
-            padding = torch.zeros(batch_size, padding_needed, device=state.device)
-            state = torch.cat([state, padding], dim=1)
-            total_features = state.size(1)
-        
-        asset_features = state[:, :asset_features_total]
+        asset_features = state[:, :asset_features_total].view(batch_size, num_assets, self.features_per_asset)
         extra_features = state[:, asset_features_total:] if total_features > asset_features_total else None
         
-        try:
-            asset_features = asset_features.view(batch_size, num_assets, self.features_per_asset)
-        except RuntimeError as e:
-            # Se si verifica un errore, gestiamo il fallback
-            total_elements = asset_features.numel()
-            safe_features_per_asset = total_elements // (batch_size * num_assets)
-            self.features_per_asset = safe_features_per_asset
-            asset_features = asset_features[:, :batch_size * num_assets * safe_features_per_asset]
-            asset_features = asset_features.view(batch_size, num_assets, safe_features_per_asset)
-        
         x = F.relu(self.fc1(asset_features))
+        # Encoding per asset [batch, num_assets, output_size] e feature extra separate
         asset_encodings = F.relu(self.fc2(x))
-        asset_encodings = asset_encodings.view(batch_size, num_assets * self.output_size)
-        if extra_features is not None:
-            return torch.cat((asset_encodings, extra_features), dim=1)
-        return asset_encodings
+        return asset_encodings, extra_features
 
 class EnhancedPortfolioActor(nn.Module):
     def __init__(self, state_size, action_size, features_per_asset, seed=0, 
                  fc1_units=256, fc2_units=128, encoding_size=32, use_attention=True,
-                 attention_size=None, encoder_output_size=None):
+                 attention_size=None, encoder_output_size=None, use_checkpoint=False, compile_forward=False):
         super(EnhancedPortfolioActor, self).__init__()
         self.seed = torch.manual_seed(seed)
         self.action_size = action_size
         self.features_per_asset = features_per_asset
         self.use_attention = use_attention
+        # Ricalcola encoder + attention nel backward invece di conservarne le attivazioni
+        self.use_checkpoint = use_checkpoint
         
         self.asset_encoder = AssetEncoder(features_per_asset, encoding_size=encoding_size, seed=seed,
                                           output_size=encoder_output_size)
         
         self.extra_features = state_size - (features_per_asset * action_size)
-        self.attention = None
-        self.value = None
-        self.fc1 = None
-        self.fc2 = None
-        self.fc3 = None
         
-        self.ln1 = None
-        self.ln2 = None
+        encoding_dim = self.asset_encoder.output_size
+        if use_attention:
+            self.attention = nn.Linear(encoding_dim, 1)
+            self.value = nn.Linear(encoding_dim, encoding_dim)
+        else:
+            self.attention = None
+            self.value = None
         
         self.fc1_units = fc1_units
         self.fc2_units = fc2_units
         
-        self.layers_initialized = False
-        self.effective_encoding_size = None
-        self.fc_input_size = None
-    
-    def initialize_layers(self, encoded_size):
-        # Inizializza i layer FC dinamicamente
-        self.fc1 = nn.Linear(encoded_size, self.fc1_units)
-        self.ln1 = nn.LayerNorm(self.fc1_units)
-        self.fc2 = nn.Linear(self.fc1_units, self.fc2_units)
-        self.ln2 = nn.LayerNorm(self.fc2_units)
-        self.fc3 = nn.Linear(self.fc2_units, self.action_size)
+        # Dimensione dell'input dei layer FC nota a priori: [asset (N*E), contesto (E), extra].
+        # Il contesto dell'attention è uguale per tutti gli asset ed entra una volta sola
+        self.fc_input_size = action_size * encoding_dim + (encoding_dim if use_attention else 0) + self.extra_features
+        
+        self.fc1 = nn.Linear(self.fc_input_size, fc1_units)
+        # I checkpoint con fc1 sul vecchio input [asset_i, contesto] per asset vengono ripiegati al caricamento
+        self._register_load_state_dict_pre_hook(self._fold_legacy_fc1)
+        self.ln1 = nn.LayerNorm(fc1_units)
+        self.fc2 = nn.Linear(fc1_units, fc2_units)
+        self.ln2 = nn.LayerNorm(fc2_units)
+        self.fc3 = nn.Linear(fc2_units, action_size)
         self.reset_parameters()
-        self.layers_initialized = True
+        
+        # Layer costruiti una volta sola: il forward ha shape statiche e può essere
+        # catturato in un CUDA graph da torch.compile(mode='reduce-overhead')
+        self._compiled_forward = None
+        if compile_forward:
+            self._compiled_forward = torch.compile(self._raw_forward, mode='reduce-overhead', dynamic=False)
     
     def reset_parameters(self):
-        if self.fc1 is not None:
-            self.fc1.weight.data.uniform_(*hidden_init(self.fc1))
-            self.fc1.bias.data.fill_(0)
-        if self.fc2 is not None:
-            self.fc2.weight.data.uniform_(*hidden_init(self.fc2))
-            self.fc2.bias.data.fill_(0)
-        if self.fc3 is not None:
-            self.fc3.weight.data.uniform_(-3e-4, 3e-4)
-            self.fc3.bias.data.fill_(0)
-    
-    def initialize_attention_layers(self, effective_encoding_size):
-        self.attention = nn.Linear(effective_encoding_size, 1)
-        self.value = nn.Linear(effective_encoding_size, effective_encoding_size)
-        fan_in = effective_encoding_size
-        lim = 1.0 / np.sqrt(fan_in)
-        self.attention.weight.data.uniform_(-lim, lim)
-        self.attention.bias.data.fill_(0)
-        self.value.weight.data.uniform_(-lim, lim)
-        self.value.bias.data.fill_(0)
-        self.effective_encoding_size = effective_encoding_size
-    
-    def apply_attention(self, encoded_assets, batch_size):
-        total_size = encoded_assets.size(1)
-        extra_features = None
-        if self.extra_features > 0 and total_size > self.action_size * self.features_per_asset:
-            extra_features = encoded_assets[:, -self.extra_features:]
-            encoded_assets = encoded_assets[:, :-self.extra_features]
-            total_size = encoded_assets.size(1)
-        
-        if total_size % self.action_size == 0:
-            effective_encoding_size = total_size // self.action_size
+        if self.use_attention:
+            # Stessa init del layer sul vecchio input [asset_i, contesto] per asset, poi ripiegata
+            n, e = self.action_size, self.asset_encoder.output_size
+            legacy_in = 2 * n * e + self.extra_features
+            lim = 1.0 / math.sqrt(legacy_in)
+            with torch.no_grad():
+                legacy = torch.empty(self.fc1_units, legacy_in).uniform_(-lim, lim)
+                self.fc1.weight.copy_(self._fold_fc1_weight(legacy))
         else:
-            effective_encoding_size = (total_size + self.action_size - 1) // self.action_size
-            padding_needed = effective_encoding_size * self.action_size - total_size
-            if padding_needed > 0:
-                padding = torch.zeros(batch_size, padding_needed, device=encoded_assets.device)
-                encoded_assets = torch.cat([encoded_assets, padding], dim=1)
-                total_size = encoded_assets.size(1)
-        
-        if self.attention is None or self.value is None or self.effective_encoding_size != effective_encoding_size:
-            self.initialize_attention_layers(effective_encoding_size)
-        
-        try:
-            assets = encoded_assets.view(batch_size, self.action_size, effective_encoding_size)
-        except RuntimeError as e:
-            total_elements = encoded_assets.numel()
-            safe_encoding_size = total_elements // (batch_size * self.action_size)
-            self.initialize_attention_layers(safe_encoding_size)
-            assets = encoded_assets.view(batch_size, self.action_size, safe_encoding_size)
-            effective_encoding_size = safe_encoding_size
-        
-        attention_scores = self.attention(assets).squeeze(-1)
-        attention_weights = F.softmax(attention_scores, dim=1).unsqueeze(-1)
+            nn.init.uniform_(self.fc1.weight, *hidden_init(self.fc1))
+        nn.init.zeros_(self.fc1.bias)
+        nn.init.uniform_(self.fc2.weight, *hidden_init(self.fc2))
+        nn.init.zeros_(self.fc2.bias)
+        nn.init.uniform_(self.fc3.weight, -3e-4, 3e-4)
+        nn.init.zeros_(self.fc3.bias)
+        if self.attention is not None:
+            lim = 1.0 / math.sqrt(self.attention.in_features)
+            nn.init.uniform_(self.attention.weight, -lim, lim)
+            nn.init.zeros_(self.attention.bias)
+            nn.init.uniform_(self.value.weight, -lim, lim)
+            nn.init.zeros_(self.value.bias)
+    
+    def apply_attention(self, assets):
+        if self._compiled_forward is not None:
+            # Sotto torch.compile (dynamic=False) Inductor fonde le einsum con N piccolo
+            # in un unico kernel, cosa che non può fare con la chiamata opaca a SDPA
+            return _attention_context(assets, self.attention.weight[0], self.value.weight, self.value.bias)
+        batch_size = assets.size(0)
+        # Attention a query singola: la query appresa è il peso di self.attention (il bias è
+        # costante sugli asset e si annulla nella softmax), chiavi = encoding degli asset.
+        # Il kernel fuso di SDPA calcola softmax(q·kᵀ)·v senza materializzare gli score
+        query = self.attention.weight.unsqueeze(0).expand(batch_size, -1, -1)
         values = self.value(assets)
-        context = (attention_weights * values).sum(dim=1)
-        context_expanded = context.unsqueeze(1).expand(-1, self.action_size, -1)
-        enhanced_assets = torch.cat((assets, context_expanded), dim=2)
-        enhanced_size = enhanced_assets.size(2) * self.action_size
-        flattened = enhanced_assets.view(batch_size, enhanced_size)
-        if extra_features is not None:
-            flattened = torch.cat((flattened, extra_features), dim=1)
-        return flattened
+        # Contesto [B, E], unico per tutti gli asset
+        return F.scaled_dot_product_attention(query, assets, values, scale=1.0).squeeze(1)
     
-    def forward(self, state):
-        batch_size = state.size(0)
-        encoded_state = self.asset_encoder(state, self.action_size)
+    def _encode_and_attend(self, state):
+        assets, extra_features = self.asset_encoder(state, self.action_size)
+        parts = [assets.reshape(state.size(0), -1)]
         if self.use_attention:
-            encoded_state = self.apply_attention(encoded_state, batch_size)
-        if not self.layers_initialized or self.fc1.weight.shape[1] != encoded_state.size(1):
-            self.initialize_layers(encoded_state.size(1))
-        x = F.relu(self.ln1(self.fc1(encoded_state)))
+            # Il contesto entra una volta sola, non replicato per ogni asset
+            parts.append(self.apply_attention(assets))
+        if extra_features is not None:
+            parts.append(extra_features)
+        return torch.cat(parts, dim=1) if len(parts) > 1 else parts[0]
+    
+    def _fold_fc1_weight(self, weight):
+        """[U, N*2E + extra] pesi sull'input [asset_i, contesto] per asset -> [U, N*E + E + extra]."""
+        # Essendo il contesto uguale per tutti gli asset, le N colonne che lo ricevono si sommano
+        n, e = self.action_size, self.asset_encoder.output_size
+        w_assets = weight[:, :2 * n * e].reshape(-1, n, 2, e)
+        return torch.cat((w_assets[:, :, 0].reshape(-1, n * e), w_assets[:, :, 1].sum(dim=1),
+                          weight[:, 2 * n * e:]), dim=1)
+    
+    def _fold_legacy_fc1(self, state_dict, prefix, *args):
+        key = prefix + 'fc1.weight'
+        weight = state_dict.get(key)
+        if (self.use_attention and weight is not None and weight.dim() == 2
+                and weight.size(1) != self.fc_input_size
+                and weight.size(1) == 2 * self.action_size * self.asset_encoder.output_size + self.extra_features):
+            state_dict[key] = self._fold_fc1_weight(weight)
+    
+    def _head(self, x):
+        x = F.relu(self.ln1(self.fc1(x)))
         x = F.relu(self.ln2(self.fc2(x)))
         return self.fc3(x)
     
+    def forward(self, state):
+        if self._compiled_forward is not None:
+            return self._compiled_forward(state)
+        return self._raw_forward(state)
+    
+    def _raw_forward(self, state):
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            encoded_state = checkpoint(self._encode_and_attend, state, use_reentrant=False, preserve_rng_state=False)
+        else:
+            encoded_state = self._encode_and_attend(state)
+        return self._head(encoded_state)
+    
 # Add to portfolio_models.py
 class MAMLPortfolioActor(EnhancedPortfolioActor):
     def __init__(self, *args, **kwargs):
@@ -30,6 +30,9 @@ Arguments:
     --commission_rate FLOAT     Trading commission rate (default: 0.0025)
     --free_trades INT           Number of free trades per month (default: 10)
     --learning_setup TEXT       Either 'full' or 'fast' for different training setups
+    --compile / --no-compile    Compile actor/critic forward with torch.compile (default: on with CUDA)
+    --tensorboard_log_interval INT  Compute and log enhanced metrics every N episodes (default: 10)
+    --verbose_test_analytics    Print the detailed position/correlation/diversification test analysis
 """
 
 #py run_enhanced_portfolio_training.py 
@@ -46,24 +49,25 @@ Arguments:
 #py run_enhanced_portfolio_training.py --learning_setup full --output_dir results/calendar_training --episodes 3 --use_calendar --calendar_path calendar.csv
 
 import os
-import torch
+import re
+import json
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 from tqdm import tqdm
 from datetime import datetime
-from collections import deque
+from collections import deque, defaultdict
+from functools import reduce, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 import argparse
 
 # Import our modules
-from portfolio_agent import PortfolioAgent, AdaptiveExploration
+# (torch, matplotlib, agente e rilevatore di regime sono importati dove servono:
+#  --help e il solo caricamento dati non pagano l'inizializzazione di torch/CUDA)
 from portfolio_env import PortfolioEnvironment
-from portfolio_models import PortfolioCritic, EnhancedPortfolioActor, DistributionalCritic, MAMLPortfolioActor
-from market_regime import MarketRegimeDetector
 from financial_calendar import FinancialCalendar
 from portfolio_construction import HybridPortfolioConstructor
 from backtesting import BacktestFramework
-from financial_calendar import FinancialCalendar
 
 # List of tickers to use in the portfolio
 TICKERS = ["ARKG", "IBB", "IHI", "IYH", "XBI", "VHT"]
@@ -90,6 +94,27 @@ norm_columns = [
     "pred_lstm", "pred_gru", "pred_blstm", "pred_lstm_direction",
     "pred_gru_direction", "pred_blstm_direction"
 ]
+NORM_COLUMNS = tuple(norm_columns)
+NORM_COLUMNS_SET = frozenset(norm_columns)
+
+# Schema fisso delle feature: lette direttamente come float32 (meta' banda rispetto a float64)
+NORM_DTYPES = dict.fromkeys(NORM_COLUMNS, np.float32)
+
+# Colonne di prezzo lette dall'ambiente (adjClose, in alternativa close) oltre a date e feature
+PRICE_COLUMNS = ["adjClose", "close"]
+
+# Gli scalari del monitor (un dizionario per episodio registrato) vengono scritti ogni SCALAR_FLUSH_EVERY episodi
+SCALAR_FLUSH_EVERY = 50
+
+@dataclass(frozen=True, slots=True)
+class RunConfig:
+    """Invarianti di una run, costruite una volta in main e condivise (immutabili) tra le funzioni."""
+    tickers: tuple
+    num_assets: int
+    features_per_asset: int
+    norm_columns: tuple
+    max_steps: int
+    output_dir: str
 
 def check_file_exists(file_path):
     """Verify if a file exists and print an appropriate message."""
@@ -98,6 +123,62 @@ def check_file_exists(file_path):
         return False
     return True
 
+def _read_ticker_csv(csv_path, used_columns):
+    """Read one ticker CSV; returns (df, missing_cols) with df sorted by date (if present)."""
+    df = pd.read_csv(csv_path, usecols=lambda col: col in used_columns, dtype=NORM_DTYPES)
+    
+    # Check for all required columns (una sola differenza tra insiemi)
+    missing_cols = sorted(NORM_COLUMNS_SET.difference(df.columns))
+    if missing_cols:
+        return None, missing_cols
+    
+    # Sort dataset by date (if present)
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'], format='ISO8601', cache=True)
+        df = df.sort_values('date')
+    return df, missing_cols
+
+# Checkpoint dell'actor con numero di episodio finale (es. portfolio_actor_120.pth)
+_ACTOR_CHECKPOINT_RE = re.compile(r'portfolio_actor_(?:.*_)?(\d+)\.pth$')
+
+def _find_last_actor_checkpoint(weights_dir):
+    """
+    Single scan of weights_dir: return the actor checkpoint with the highest episode number,
+    else the 'initial' one, else any portfolio_actor_*.pth (None if there is none).
+    """
+    best_n, best_file, fallback = -1, None, None
+    with os.scandir(weights_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if not (name.startswith('portfolio_actor_') and name.endswith('.pth')):
+                continue
+            match = _ACTOR_CHECKPOINT_RE.match(name)
+            if match:
+                n = int(match.group(1))
+                if n > best_n:
+                    best_n, best_file = n, name
+            elif fallback is None or ('initial' in name and 'initial' not in fallback):
+                fallback = name
+    return best_file if best_file is not None else fallback
+
+@lru_cache(maxsize=4)
+def _load_calendar(calendar_path):
+    """Parse the calendar CSV once per path; repeated runs in the same process reuse it."""
+    return FinancialCalendar(calendar_path)
+
+def _maybe_load_calendar(args):
+    """Return the FinancialCalendar requested by --use_calendar/--calendar_path, or None."""
+    if not args.use_calendar:
+        return None
+    calendar_path = args.calendar_path
+    if calendar_path and os.path.exists(calendar_path):
+        print(f"Loading financial calendar from {calendar_path}...")
+        calendar = _load_calendar(calendar_path)
+        print(f"Loaded {calendar.n_events} events")
+        return calendar
+    print(f"WARNING: Calendar file {calendar_path} not found. Running without calendar.")
+    return None
+
 def load_data_for_tickers(tickers, train_fraction=0.8):
     """
     Load and prepare data for all tickers.
@@ -117,30 +198,35 @@ def load_data_for_tickers(tickers, train_fraction=0.8):
     norm_params_paths = {}
     valid_tickers = []
     
+    # Solo le colonne effettivamente usate: le altre non vengono nemmeno parsate
+    used_columns = NORM_COLUMNS_SET.union(PRICE_COLUMNS, ('date',))
+    
+    # Verify file existence
+    to_load = []
     for ticker in tickers:
         norm_params_path = f'{NORM_PARAMS_PATH_BASE}{ticker}_norm_params.json'
         csv_path = f'{CSV_PATH_BASE}{ticker}\\{ticker}_normalized.csv'
-        
-        # Verify file existence
         if not (check_file_exists(norm_params_path) and check_file_exists(csv_path)):
             print(f"Skipping ticker {ticker} due to missing files")
             continue
-        
-        # Load dataset
+        to_load.append((ticker, csv_path, norm_params_path))
+    
+    if not to_load:
+        return dfs_train, dfs_test, norm_params_paths, valid_tickers
+    
+    # Parsing dei CSV in parallelo (pandas rilascia il GIL durante il parsing);
+    # map restituisce i risultati nell'ordine dei ticker, così i print non si mescolano
+    for ticker, _, _ in to_load:
         print(f"Loading data for {ticker}...")
-        df = pd.read_csv(csv_path)
-        
-        # Check for all required columns
-        missing_cols = [col for col in norm_columns if col not in df.columns]
+    max_workers = min(len(to_load), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        loaded = list(executor.map(lambda item: _read_ticker_csv(item[1], used_columns), to_load))
+    
+    for (ticker, _, norm_params_path), (df, missing_cols) in zip(to_load, loaded):
         if missing_cols:
             print(f"Skipping ticker {ticker}. Missing columns: {missing_cols}")
             continue
         
-        # Sort dataset by date (if present)
-        if 'date' in df.columns:
-            df['date'] = pd.to_datetime(df['date'])
-            df = df.sort_values('date')
-        
         # Split into training and test
         train_size = int(len(df) * train_fraction)
         dfs_train[ticker] = df.iloc[:train_size]
@@ -152,6 +238,13 @@ def load_data_for_tickers(tickers, train_fraction=0.8):
     
     return dfs_train, dfs_test, norm_params_paths, valid_tickers
 
+def _tail_mean(values, k=3):
+    """Mean of the last k values of a deque/list, reading only those k elements."""
+    n = len(values)
+    if n == 0:
+        return np.nan
+    return np.mean([values[i] for i in range(max(0, n - k), n)])
+
 def save_results(results, output_dir, tickers, enhancement_config):
     """
     Save training results with information about which enhancements were used.
@@ -159,22 +252,22 @@ def save_results(results, output_dir, tickers, enhancement_config):
     try:
         # Extract metrics safely
         if isinstance(results['final_rewards'], deque):
-            final_reward = np.mean(list(results['final_rewards'])[-3:]) if len(results['final_rewards']) >= 3 else np.mean(list(results['final_rewards']))
+            final_reward = _tail_mean(results['final_rewards'])
         else:
             final_reward = results['final_rewards']
             
         if isinstance(results['final_portfolio_values'], deque):
-            final_portfolio_value = np.mean(list(results['final_portfolio_values'])[-3:]) if len(results['final_portfolio_values']) >= 3 else np.mean(list(results['final_portfolio_values']))
+            final_portfolio_value = _tail_mean(results['final_portfolio_values'])
         else:
             final_portfolio_value = results['final_portfolio_values']
             
         if isinstance(results['final_sharpe_ratios'], deque):
-            final_sharpe_ratio = np.mean(list(results['final_sharpe_ratios'])[-3:]) if len(results['final_sharpe_ratios']) >= 3 else np.mean(list(results['final_sharpe_ratios']))
+            final_sharpe_ratio = _tail_mean(results['final_sharpe_ratios'])
         else:
             final_sharpe_ratio = results['final_sharpe_ratios']
 
         if 'cvar_values' in results and len(results['cvar_values']) > 0:
-            final_cvar = np.mean(list(results['cvar_values'])[-3:]) if len(results['cvar_values']) >= 3 else np.mean(list(results['cvar_values']))
+            final_cvar = _tail_mean(results['cvar_values'])
         else:
             final_cvar = None
             
@@ -215,8 +308,29 @@ def save_results(results, output_dir, tickers, enhancement_config):
             pickle.dump(results, f)
         print(f"Raw results saved in: {output_dir}\\raw_results.pkl")
 
+# Serie per episodio salvate nel log delle metriche
+EPISODE_METRICS = ['cum_rewards', 'final_rewards', 'final_portfolio_values', 'final_sharpe_ratios',
+                   'cvar_values', 'regime_changes', 'exploration_rates', 'diversification_metrics']
+
+def save_episode_metrics(results, output_dir):
+    """
+    Write the per-episode series in a single columnar CSV, once at the end of training.
+    Series of different length are padded with NaN.
+    """
+    columns = {key: pd.Series(list(results[key]), dtype=float)
+               for key in EPISODE_METRICS if key in results and len(results[key]) > 0}
+    if not columns:
+        return
+    metrics_file = f'{output_dir}\\episode_metrics.csv'
+    pd.DataFrame(columns).rename_axis('episode').to_csv(metrics_file)
+    print(f"Episode metrics saved in: {metrics_file}")
+
 def plot_enhanced_performance(results, output_dir, tickers, enhancement_config):
     """Create visualizations of training performance with enhanced metrics."""
+    import matplotlib
+    matplotlib.use('Agg')  # Solo salvataggio su file, nessun backend interattivo
+    import matplotlib.pyplot as plt
+    
     plt.figure(figsize=(15, 12))
     
     # Plot cumulative rewards
@@ -291,6 +405,7 @@ def plot_enhanced_performance(results, output_dir, tickers, enhancement_config):
     
     plt.tight_layout()
     plt.savefig(f'{output_dir}\\enhanced_performance.png')
+    plt.close()
     print(f"Performance visualization saved in: {output_dir}\\enhanced_performance.png")
 
 def align_dataframes(dfs):
@@ -299,32 +414,21 @@ def align_dataframes(dfs):
     """
     aligned_dfs = {}
     
-    # Find common date range
+    # Find common dates
     if all('date' in df.columns for df in dfs.values()):
-        # Find most recent start date
-        start_date = max(df['date'].min() for df in dfs.values())
-        # Find earliest end date
-        end_date = min(df['date'].max() for df in dfs.values())
+        # Intersezione hash delle date di tutti i ticker: ogni frame viene poi riallineato
+        # con un unico gather, senza maschere booleane, riordinamenti o troncamenti
+        date_indexes = [pd.Index(df['date']) for df in dfs.values()]
+        common_dates = reduce(pd.Index.intersection, date_indexes).sort_values()
         
-        print(f"Common date range: {start_date} - {end_date}")
+        if len(common_dates) > 0:
+            print(f"Common date range: {common_dates[0]} - {common_dates[-1]}")
         
-        # Filter and align each DataFrame
-        for ticker, df in dfs.items():
-            aligned_df = df[(df['date'] >= start_date) & (df['date'] <= end_date)].copy()
-            # Make sure dates are sorted
-            aligned_df = aligned_df.sort_values('date')
-            aligned_dfs[ticker] = aligned_df
-        
-        # Check that all aligned DataFrames have the same number of rows
-        lengths = [len(df) for df in aligned_dfs.values()]
-        if len(set(lengths)) > 1:
-            print(f"WARNING: Aligned DataFrames have different lengths: {lengths}")
-            # Find minimum length
-            min_length = min(lengths)
-            print(f"Truncating to {min_length} rows...")
-            # Truncate all DataFrames to the same length
-            for ticker in aligned_dfs:
-                aligned_dfs[ticker] = aligned_dfs[ticker].iloc[:min_length].copy()
+        for (ticker, df), dates in zip(dfs.items(), date_indexes):
+            indexed = df.set_index(dates)
+            if not dates.is_unique:
+                indexed = indexed[~dates.duplicated()]
+            aligned_dfs[ticker] = indexed.reindex(common_dates).reset_index(drop=True)
     else:
         # If no 'date' columns, use the minimum number of rows
         min_rows = min(len(df) for df in dfs.values())
@@ -337,22 +441,29 @@ def align_dataframes(dfs):
     
     return aligned_dfs
 
-def create_enhanced_agent(args, num_assets, max_steps, features_per_asset, output_dir):
+def create_enhanced_agent(args, cfg):
     """
     Create an agent with the selected enhancements based on argument flags.
     """
+    import torch
+    from portfolio_agent import PortfolioAgent, AdaptiveExploration
+    
     agent = None
     
+    # torch.compile(mode='reduce-overhead') di default solo su GPU, dove i CUDA graph ripagano la compilazione
+    compile_models = args.compile if args.compile is not None else torch.cuda.is_available()
+    
     # Base configuration
     agent_config = {
-        'num_assets': num_assets,
+        'num_assets': cfg.num_assets,
         'memory_type': "prioritized",
         'batch_size': 256,
-        'max_step': max_steps,
+        'max_step': cfg.max_steps,
         'theta': 0.03,
         'sigma': 0.05,
         'use_enhanced_actor': True,
-        'use_batch_norm': True
+        'use_batch_norm': True,
+        'compile_models': compile_models
     }
     
     # Create agent with base configuration
@@ -362,38 +473,31 @@ def create_enhanced_agent(args, num_assets, max_steps, features_per_asset, outpu
     if args.use_adaptive_exploration:
         print("Initializing adaptive exploration strategy...")
         agent.noise = AdaptiveExploration(
-            action_size=num_assets, 
+            action_size=cfg.num_assets, 
             theta=0.1, 
             sigma=0.2, 
             min_sigma=0.05
         )
     
     # Save the configuration
-    agent_config_path = f'{output_dir}\\agent_config.json'
+    agent_config_path = f'{cfg.output_dir}\\agent_config.json'
     with open(agent_config_path, 'w') as f:
-        import json
         json.dump(agent_config, f, indent=4)
     
     return agent
 
 # Modifica la funzione create_enhanced_environment per risolvere il problema di serializzazione
-def create_enhanced_environment(args, valid_tickers, aligned_dfs_train, norm_params_paths, max_steps, output_dir):
+def create_enhanced_environment(args, cfg, aligned_dfs, norm_params_paths, calendar=None):
     """
     Create the portfolio environment with enhanced features based on argument flags.
+    The financial calendar, if used, is loaded once by the caller and passed in.
     """
-    calendar = None
-    if args.use_calendar and args.calendar_path and os.path.exists(args.calendar_path):
-        print(f"Loading financial calendar from {args.calendar_path}...")
-        from financial_calendar import FinancialCalendar
-        calendar = FinancialCalendar(args.calendar_path)
-        print(f"Loaded events from calendar.")
-    
-    # Base configuration
+    # Base configuration: solo valori JSON-serializzabili, salvata così com'è in env_config.json
     env_config = {
-        'tickers': valid_tickers,
+        'tickers': list(cfg.tickers),
         'sigma': 0.1,
         'theta': 0.1,
-        'T': max_steps,
+        'T': cfg.max_steps,
         'lambd': 0.05,
         'psi': 0.2,
         'cost': "trade_l1",
@@ -405,10 +509,8 @@ def create_enhanced_environment(args, valid_tickers, aligned_dfs_train, norm_par
         'beta': 3,
         'clip': True,
         'scale_reward': 5,
-        'dfs': aligned_dfs_train,  # Questo è un DataFrame e causa il problema
-        'max_step': max_steps,
-        'norm_params_paths': norm_params_paths,
-        'norm_columns': norm_columns,
+        'max_step': cfg.max_steps,
+        'norm_columns': list(cfg.norm_columns),
         'free_trades_per_month': args.free_trades,
         'commission_rate': args.commission_rate,
         'min_commission': 1.0 if args.commission_rate > 0 else 0.0,
@@ -419,119 +521,106 @@ def create_enhanced_environment(args, valid_tickers, aligned_dfs_train, norm_par
         'initial_capital': 100000,
         'risk_free_rate': 0.02,
         'use_sortino': True,
-        'target_return': 0.05,
-        'calendar':calendar
+        'target_return': 0.05
     }
     
-    # Create the environment with the configuration
-    env = PortfolioEnvironment(**env_config)
+    # Create the environment with the configuration plus the runtime objects (DataFrames, calendar)
+    env = PortfolioEnvironment(**env_config, dfs=aligned_dfs, norm_params_paths=norm_params_paths,
+                               calendar=calendar)
     
     # If using market regime detection, prepare the detector
     if args.use_market_regimes:
         print("Initializing market regime detector...")
         # This will be used in the main training loop,
         # not directly in environment initialization
-        
-    # If using financial calendar, set it up
-    calendar = None
-    if args.use_calendar and args.calendar_path and os.path.exists(args.calendar_path):
-        print(f"Loading financial calendar from {args.calendar_path}...")
-        calendar = FinancialCalendar(args.calendar_path)
-        print(f"Loaded {sum(len(events) for events in calendar.events.values())} events")
-    else:
-        print("Calendar not found or not enabled. Running without calendar integration.")
-
     
-    # Save the environment configuration (omitting non-serializable parts)
-    env_config_path = f'{output_dir}\\env_config.json'
+    # Save the environment configuration (norm params as a simple list of paths)
+    env_config_path = f'{cfg.output_dir}\\env_config.json'
     with open(env_config_path, 'w') as f:
-        import json
-        # Create a copy with only serializable items
-        serializable_config = {}
-        for k, v in env_config.items():
-            if k == 'dfs':
-                # Skip DataFrames
-                continue
-            elif k == 'norm_params_paths':
-                # Convert dict to a simple list of paths
-                serializable_config[k] = list(v.values()) if v else []
-            elif isinstance(v, (int, float, bool, str, list, type(None))):
-                serializable_config[k] = v
-            else:
-                # Convert other non-serializable objects to strings
-                serializable_config[k] = str(v)
-                
-        json.dump(serializable_config, f, indent=4)
+        json.dump({**env_config, 'norm_params_paths': list(norm_params_paths.values())}, f, indent=4)
     
     return env
 
-def monitor_enhanced_metrics(env, agent, episode, i, writer, regime_detector=None, calendar=None, results=None):
+def flush_pending_scalars(writer, pending):
+    """Write buffered scalars with one add_scalars("episode", ...) call per episode, then clear the buffer."""
+    # Nessun writer.flush() qui: la coda del writer (max_queue) raggruppa le scritture su disco
+    if writer:
+        for step, values in pending:
+            writer.add_scalars("episode", values, step)
+    pending.clear()
+
+def compute_all_metrics(env, agent, pending, i, results, regime_detector=None, calendar=None,
+                        episode=None, log_interval=1, dates=None):
     """
-    Track enhanced metrics during training, especially those related to the new features.
+    Track enhanced metrics at the end of an episode in a single pass.
+    Portfolio metrics are read once from the environment and reused; the episode's scalars
+    are appended as one (i, {tag: value}) record to pending, flushed by the caller.
+    Metrics are only computed every log_interval episodes (episode, or i if not given).
+    dates is the environment's date array, resolved once by the caller (default: env._date_array).
     """
-    # If first call, initialize the results dictionary
-    if results is None:
-        results = {
-            'cvar_values': [],
-            'regime_changes': [],
-            'exploration_rates': [],
-            'diversification_metrics': [],
-            'meta_learning_adaptations': []
-        }
-    
-    # Calculate and record CVaR
-    cvar = env.calculate_conditional_value_at_risk(confidence_level=0.95)
-    results['cvar_values'].append(cvar)
-    if writer:
-        writer.add_scalar("Risk/CVaR", cvar, i)
+    # Scalari dell'episodio raggruppati per tag principale: {gruppo: {nome: valore}}
+    scalars = defaultdict(dict)
     
-    # If using adaptive exploration, record the current sigma
-    if hasattr(agent.noise, 'adapt_sigma'):
-        # Assuming we have some performance metric to adapt to
+    # If using adaptive exploration, adapt sigma every episode (guida l'esplorazione, non e' solo log)
+    if agent.noise.adaptive:
+        # Metriche di portafoglio lette una sola volta per episodio
         portfolio_metrics = env.get_real_portfolio_metrics()
         current_sharpe = portfolio_metrics['sharpe_ratio']
         # Adapt sigma based on Sharpe ratio (target is something like 1.0 for good performance)
         current_sigma = agent.noise.adapt_sigma(max(0.01, current_sharpe), 1.0)
+    
+    # Metriche e scalari solo ogni log_interval episodi
+    if (i if episode is None else episode) % log_interval:
+        return results
+    
+    # Calculate and record CVaR
+    cvar = env.calculate_conditional_value_at_risk(confidence_level=0.95)
+    results['cvar_values'].append(cvar)
+    scalars["Risk"]["CVaR"] = cvar
+    
+    # Record the current sigma
+    if agent.noise.adaptive:
         results['exploration_rates'].append(current_sigma)
-        if writer:
-            writer.add_scalar("Exploration/Current_Sigma", current_sigma, i)
+        scalars["Exploration"]["Current_Sigma"] = current_sigma
     
     # If using market regime detection
     if regime_detector is not None:
-        # Get price history to detect regime
-        ticker = env.tickers[0]  # Example: use first ticker for simplicity
-        price_history = np.array(env.price_history[ticker])
-        if len(price_history) > regime_detector.window_size:
+        # Example: use first ticker for simplicity. Solo gli ultimi window_size + 1 prezzi,
+        # come vista sul buffer: costo O(window_size) indipendente dalla lunghezza della storia
+        window_size = regime_detector.window_size
+        price_history = env.get_price_window(0, window_size + 1)
+        if len(price_history) > window_size:
+            # Chiamata una volta per episodio: nuova stima dell'HMM sulla finestra corrente
+            regime_detector.reset()
             current_regime = regime_detector.detect_regime(price_history)
             results['regime_changes'].append(current_regime)
-            if writer:
-                writer.add_scalar("Market/Current_Regime", current_regime, i)
+            scalars["Market"]["Current_Regime"] = current_regime
     
     # Record diversification metrics
     diversification = env.calculate_diversification_bonus() / env.diversification_bonus_factor
     results['diversification_metrics'].append(diversification)
-    if writer:
-        writer.add_scalar("Portfolio/Diversification", diversification, i)
+    scalars["Portfolio"]["Diversification"] = diversification
     
     # If using financial calendar
-    if calendar is not None:
-        # Get current date
-        if all('date' in df.columns for df in env.dfs.values()):
-            current_date = list(env.dfs.values())[0]['date'].iloc[env.current_index]
-            upcoming_events = calendar.get_upcoming_events(current_date)
-            if upcoming_events and writer:
-                # Count events by importance
-                importance_count = {}
-                for event in upcoming_events:
-                    imp = event['importance']
-                    importance_count[imp] = importance_count.get(imp, 0) + 1
-                for imp, count in importance_count.items():
-                    writer.add_scalar(f"Calendar/Events_{imp}", count, i)
+    if dates is None:
+        dates = env._date_array
+    if calendar is not None and dates is not None:
+        current_date = dates[env.current_index]
+        # Count events by importance (Counter direttamente sugli array del calendario)
+        importance_count = calendar.count_upcoming_events(current_date)
+        if importance_count:
+            scalars["Calendar/Events"] = {str(imp): count for imp, count in importance_count.items()}
+    
+    # Un solo dizionario per episodio ("Risk" / "CVaR" -> "Risk_CVaR"), scritto con un'unica add_scalars
+    pending.append((i, {f"{tag_group.replace('/', '_')}_{name}": value
+                        for tag_group, values in scalars.items() for name, value in values.items()}))
     
     return results
 
 def main(args):
     """Main function for enhanced portfolio training."""
+    import torch
+    
     # Create output directories
     output_dir = args.output_dir
     os.makedirs(output_dir, exist_ok=True)
@@ -563,39 +652,35 @@ def main(args):
     print("Initializing the enhanced portfolio environment...")
     max_steps = min(1000, min(len(df) for df in aligned_dfs_train.values()) - 10)
     
-    env = create_enhanced_environment(
-        args, valid_tickers, aligned_dfs_train, 
-        norm_params_paths, max_steps, output_dir
+    cfg = RunConfig(
+        tickers=tuple(valid_tickers),
+        num_assets=len(valid_tickers),
+        features_per_asset=len(NORM_COLUMNS),
+        norm_columns=NORM_COLUMNS,
+        max_steps=max_steps,
+        output_dir=output_dir
     )
     
+    # Calendario caricato una sola volta e condiviso da ambiente e monitoraggio
+    calendar = _maybe_load_calendar(args)
+    
+    env = create_enhanced_environment(args, cfg, aligned_dfs_train, norm_params_paths, calendar=calendar)
+    
     # 2b. Inizializza con posizioni neutre invece che casuali
     env.positions = np.zeros(env.num_assets)
 
     # 3. Initialize the enhanced agent
     print("Initializing the enhanced portfolio agent...")
-    num_assets = len(valid_tickers)
-    agent = create_enhanced_agent(
-        args, num_assets, max_steps, 
-        len(norm_columns), output_dir
-    )
+    num_assets = cfg.num_assets
+    agent = create_enhanced_agent(args, cfg)
     
     # 4. Initialize additional components based on arguments
     regime_detector = None
-    calendar = None
     
     if args.use_market_regimes:
+        from market_regime import MarketRegimeDetector
         regime_detector = MarketRegimeDetector(window_size=60, n_regimes=3)
     
-    if args.use_calendar:
-        calendar_path = args.calendar_path
-        if os.path.exists(calendar_path):
-            print(f"Loading financial calendar from {calendar_path}...")
-            calendar = FinancialCalendar(calendar_path)
-            print(f"Loaded {sum(len(events) for events in calendar.events.values())} events")
-        else:
-            print(f"WARNING: Calendar file {calendar_path} not found. Running without calendar.")
-
-    
     # 5. Create a dictionary of which enhancements are being used
     enhancement_config = {
         'use_adaptive_exploration': args.use_adaptive_exploration,
@@ -637,7 +722,8 @@ def main(args):
             'learn_freq': 10,
             'encoding_size': 16,
             'clip_grad_norm': 1.0,
-            'early_stop_patience': 20
+            'early_stop_patience': 20,
+            'async_checkpoint': True
         }
     else:  # 'full'
         print("Using FULL learning setup (more thorough but slower)")
@@ -661,7 +747,8 @@ def main(args):
             'learn_freq': 5,
             'encoding_size': 32,
             'clip_grad_norm': 1.0,
-            'early_stop_patience': 15
+            'early_stop_patience': 15,
+            'async_checkpoint': True
         }
     
     # 7. Setup distributional critic if requested
@@ -677,8 +764,8 @@ def main(args):
     # 9. Start the training
     print(f"Starting enhanced training with {num_assets} assets...")
     
-    # Calculate features_per_asset for the EnhancedPortfolioActor
-    features_per_asset = len(norm_columns)
+    # features_per_asset for the EnhancedPortfolioActor
+    features_per_asset = cfg.features_per_asset
     
     # Setup for resuming if specified
     if args.resume:
@@ -699,98 +786,57 @@ def main(args):
     
     # Modify the standard train function to incorporate our enhancements
     class EnhancedTrainingMonitor:
-        def __init__(self):
+        def __init__(self, regime_detector=None, calendar=None, log_interval=1, dates=None):
             self.enhanced_metrics = enhanced_metrics
+            self.regime_detector = regime_detector
+            self.calendar = calendar
+            self.log_interval = log_interval
+            # Colonna date (datetime64) risolta una volta sola in fase di setup
+            self.dates = dates
             self.episode_callbacks = []
+            # Scalari in attesa di scrittura: propri di questo monitor, non condivisi tra run
+            self.pending_scalars = []
             
         def register_episode_callback(self, callback):
             self.episode_callbacks.append(callback)
             
         def on_episode_end(self, env, agent, episode, i, writer):
             """Called at the end of each episode to track enhanced metrics"""
+            # Metriche integrate calcolate in un'unica chiamata
+            compute_all_metrics(env, agent, self.pending_scalars, i, self.enhanced_metrics,
+                                regime_detector=self.regime_detector, calendar=self.calendar,
+                                episode=episode, log_interval=self.log_interval, dates=self.dates)
+            if (episode + 1) % SCALAR_FLUSH_EVERY == 0:
+                flush_pending_scalars(writer, self.pending_scalars)
+            
+            # Eventuali callback aggiuntive registrate dall'utente
             for callback in self.episode_callbacks:
                 callback(env, agent, episode, i, writer, self.enhanced_metrics)
             
             # Standard metrics will be tracked by the agent's train method
+        
+        def on_train_end(self, writer):
+            """Flush the scalars still buffered when training stops."""
+            flush_pending_scalars(writer, self.pending_scalars)
+            if writer:
+                writer.flush()
             
     # Initialize the training monitor
-    monitor = EnhancedTrainingMonitor()
-    
-    # Register callbacks for different enhancements
-    
-    # Add CVaR tracking
-    def track_cvar(env, agent, episode, i, writer, metrics):
-        cvar = env.calculate_conditional_value_at_risk(confidence_level=0.95)
-        metrics['cvar_values'].append(cvar)
-        writer.add_scalar("Risk/CVaR", cvar, i)
-    
-    monitor.register_episode_callback(track_cvar)
-    
-    # Add adaptive exploration tracking if enabled
-    # Add adaptive exploration tracking if enabled
-    if args.use_adaptive_exploration:
-        def track_adaptive_exploration(env, agent, episode, i, writer, metrics):
-            portfolio_metrics = env.get_real_portfolio_metrics()
-            current_sharpe = portfolio_metrics['sharpe_ratio']
-            current_sigma = agent.noise.adapt_sigma(max(0.01, current_sharpe), 1.0)
-            metrics['exploration_rates'].append(current_sigma)
-            writer.add_scalar("Exploration/Current_Sigma", current_sigma, i)
-        
-        monitor.register_episode_callback(track_adaptive_exploration)
-    
-    # Add market regime tracking if enabled
-    if args.use_market_regimes:
-        def track_market_regimes(env, agent, episode, i, writer, metrics):
-            ticker = env.tickers[0]  # Example: use first ticker for simplicity
-            price_history = np.array(env.price_history[ticker])
-            if len(price_history) > regime_detector.window_size:
-                current_regime = regime_detector.detect_regime(price_history)
-                metrics['regime_changes'].append(current_regime)
-                writer.add_scalar("Market/Current_Regime", current_regime, i)
-        
-        monitor.register_episode_callback(track_market_regimes)
-    
-    # Add calendar event tracking if enabled
-    if args.use_calendar and calendar is not None:
-        def track_calendar_events(env, agent, episode, i, writer, metrics):
-            if all('date' in df.columns for df in env.dfs.values()):
-                current_date = list(env.dfs.values())[0]['date'].iloc[env.current_index]
-                upcoming_events = calendar.get_upcoming_events(current_date)
-                if upcoming_events:
-                    # Count events by importance
-                    importance_count = {}
-                    for event in upcoming_events:
-                        imp = event['importance']
-                        importance_count[imp] = importance_count.get(imp, 0) + 1
-                    for imp, count in importance_count.items():
-                        writer.add_scalar(f"Calendar/Events_{imp}", count, i)
-        
-        monitor.register_episode_callback(track_calendar_events)
-    
-    # Add diversification tracking
-    def track_diversification(env, agent, episode, i, writer, metrics):
-        diversification = env.calculate_diversification_bonus() / env.diversification_bonus_factor
-        metrics['diversification_metrics'].append(diversification)
-        writer.add_scalar("Portfolio/Diversification", diversification, i)
-    
-    monitor.register_episode_callback(track_diversification)
+    monitor = EnhancedTrainingMonitor(regime_detector=regime_detector, calendar=calendar,
+                                      log_interval=args.tensorboard_log_interval,
+                                      dates=env._date_array)
     
     # Patch the agent's train method to call our monitor
     original_train = agent.train
     
     def enhanced_train(*args, **kwargs):
-        # Store original episode complete logic to hook into it
-        original_episode_complete_branch = None
-        
-        # Find and store the episode_complete branch in the train method
-        train_source = original_train.__code__.co_consts
-        for const in train_source:
-            if isinstance(const, str) and "episode_complete" in const:
-                original_episode_complete_branch = const
-                break
-        
-        # Call the original train method with our additional callback
-        results = original_train(*args, **kwargs)
+        # Il monitor riceve ogni fine episodio tramite la callback di PortfolioAgent.train
+        kwargs.setdefault('episode_callback', monitor.on_episode_end)
+        try:
+            results = original_train(*args, **kwargs)
+        finally:
+            # Anche se il training si interrompe, gli scalari bufferizzati arrivano a TensorBoard
+            monitor.on_train_end(kwargs.get('writer'))
         
         # Add our enhanced metrics to the results
         for key, value in enhanced_metrics.items():
@@ -802,6 +848,11 @@ def main(args):
     # Replace the train method with our enhanced version
     agent.train = enhanced_train
     
+    # Un solo SummaryWriter per training e test (tag di test con prefisso "test/"),
+    # con coda ampia e flush radi per ridurre le scritture su disco
+    from tensorboardX import SummaryWriter
+    writer = SummaryWriter(log_dir=f'{output_dir}\\runs\\', max_queue=10000, flush_secs=120)
+    
     # Run the actual training with all enhancements configured
     results = agent.train(
         env=env,
@@ -833,11 +884,15 @@ def main(args):
         features_per_asset=features_per_asset,
         encoding_size=training_config['encoding_size'],
         clip_grad_norm=training_config['clip_grad_norm'],
-        early_stop_patience=training_config['early_stop_patience']
+        early_stop_patience=training_config['early_stop_patience'],
+        async_checkpoint=training_config['async_checkpoint'],
+        writer=writer
     )
     
     # 10. Save results and visualizations
     save_results(results, output_dir, valid_tickers, enhancement_config)
+    # Log delle metriche e grafico generati una sola volta, a training concluso
+    save_episode_metrics(results, output_dir)
     plot_enhanced_performance(results, output_dir, valid_tickers, enhancement_config)
     
     print(f"Enhanced training completed!")
@@ -846,152 +901,163 @@ def main(args):
     
     # 11. Setup test environment with the same enhancements
     print("\nPreparing test environment...")
-    test_env = create_enhanced_environment(
-        args, valid_tickers, aligned_dfs_test, 
-        norm_params_paths, len(next(iter(aligned_dfs_test.values()))), 
-        f'{output_dir}\\test'
-    )
+    test_cfg = replace(cfg, max_steps=len(next(iter(aligned_dfs_test.values()))), output_dir=f'{output_dir}\\test')
+    test_env = create_enhanced_environment(args, test_cfg, aligned_dfs_test, norm_params_paths, calendar=calendar)
     
     # 12. Load the best model for evaluation
-    model_files = [f for f in os.listdir(f'{output_dir}\\weights\\') 
-                  if f.startswith('portfolio_actor_') and f.endswith('.pth')]
+    # Ultimo modello numerato, altrimenti 'initial' o il primo disponibile (una sola scansione)
+    last_model = _find_last_actor_checkpoint(f'{output_dir}\\weights\\')
     
-    if model_files:
-        # Filter only numeric models, excluding 'initial'
-        numeric_models = [f for f in model_files if f.split('_')[-1].split('.')[0].isdigit()]
+    if last_model:
+        last_critic = last_model.replace('actor', 'critic')
         
-        if numeric_models:
-            last_model = sorted(numeric_models, key=lambda x: int(x.split('_')[-1].split('.')[0]))[-1]
-        else:
-            # If no numeric models, use initial or first available
-            last_model = next((f for f in model_files if 'initial' in f), model_files[0] if model_files else None)
+        print(f"Loading best model: {last_model}")
+        agent.load_models(
+            actor_path=f'{output_dir}\\weights\\{last_model}',
+            critic_path=f'{output_dir}\\weights\\{last_critic}' if os.path.exists(f'{output_dir}\\weights\\{last_critic}') else None
+        )
+        
+        # 13. Run evaluation on test data
+        print("Running evaluation on test dataset...")
         
-        if last_model:
-            last_critic = last_model.replace('actor', 'critic')
+        # If we're using backtesting framework
+        if args.use_backtest_framework:
+            print("Using backtesting framework for walk-forward evaluation...")
+            # Test data in the format expected by backtester: date gia' estratte dall'ambiente di test
+            # (datetime64, nessuna copia) e solo colonne numeriche in float32, senza l'array object di df.values
+            test_periods = {'full_test': {
+                'dates': test_env._date_array,
+                **{f'data_{ticker}': df.drop(columns='date').to_numpy(dtype=np.float32)
+                   for ticker, df in aligned_dfs_test.items()}
+            }}
             
-            print(f"Loading best model: {last_model}")
-            agent.load_models(
-                actor_path=f'{output_dir}\\weights\\{last_model}',
-                critic_path=f'{output_dir}\\weights\\{last_critic}' if os.path.exists(f'{output_dir}\\weights\\{last_critic}') else None
+            # Initialize backtesting framework
+            backtest = BacktestFramework(
+                env=test_env, 
+                agent=agent, 
+                datasets=test_periods,
+                test_periods=['full_test']
             )
             
-            # 13. Run evaluation on test data
-            print("Running evaluation on test dataset...")
+            # Run walk-forward validation
+            results = backtest.walk_forward_validation(
+                window_size=60,  # 60-day windows
+                step_size=20     # Step forward 20 days at a time
+            )
             
-            # If we're using backtesting framework
-            if args.use_backtest_framework:
-                print("Using backtesting framework for walk-forward evaluation...")
-                # Create a copy of test data in the format expected by backtester
-                test_periods = {'full_test': {
-                    'dates': next(iter(aligned_dfs_test.values()))['date'].values,
-                    **{f'data_{ticker}': df.values for ticker, df in aligned_dfs_test.items()}
-                }}
-                
-                # Initialize backtesting framework
-                backtest = BacktestFramework(
-                    env=test_env, 
-                    agent=agent, 
-                    datasets=test_periods,
-                    test_periods=['full_test']
-                )
-                
-                # Run walk-forward validation
-                results = backtest.walk_forward_validation(
-                    window_size=60,  # 60-day windows
-                    step_size=20     # Step forward 20 days at a time
-                )
-                
-                # Extract and analyze results
-                print("\n=== Walk-Forward Validation Results ===")
-                all_returns = []
-                all_sharpes = []
-                all_drawdowns = []
-                
-                for period, period_results in results.items():
-                    period_returns = [r['total_return'] for r in period_results]
-                    period_sharpes = [r['sharpe_ratio'] for r in period_results]
-                    period_drawdowns = [r['max_drawdown'] for r in period_results]
-                    
-                    all_returns.extend(period_returns)
-                    all_sharpes.extend(period_sharpes)
-                    all_drawdowns.extend(period_drawdowns)
-                    
-                    print(f"\nPeriod: {period}")
-                    print(f"Mean Return: {np.mean(period_returns):.2f}%")
-                    print(f"Mean Sharpe: {np.mean(period_sharpes):.2f}")
-                    print(f"Mean Drawdown: {np.mean(period_drawdowns):.2f}%")
-                
-                print("\nOverall Performance:")
-                print(f"Mean Return: {np.mean(all_returns):.2f}%")
-                print(f"Mean Sharpe: {np.mean(all_sharpes):.2f}")
-                print(f"Mean Drawdown: {np.mean(all_drawdowns):.2f}%")
-                
-                # Save detailed backtest results
-                backtest_results_file = f'{output_dir}\\test\\backtest_results.json'
-                with open(backtest_results_file, 'w') as f:
-                    import json
-                    # Convert numpy arrays to lists for serialization
-                    serializable_results = {
-                        period: [{k: v if not isinstance(v, np.ndarray) else v.tolist() 
-                                for k, v in r.items()} 
-                                for r in period_results]
-                        for period, period_results in results.items()
-                    }
-                    json.dump(serializable_results, f, indent=4)
-                
-                print(f"Detailed backtest results saved to: {backtest_results_file}")
-                
-            else:
-                # Standard evaluation without backtesting framework
-                test_env.reset()
-                state = test_env.get_state()
-                done = test_env.done
-                
-                test_rewards = []
-                test_cvars = []
+            # Extract and analyze results
+            print("\n=== Walk-Forward Validation Results ===")
+            # Una matrice [finestre, 3] (return, sharpe, drawdown) per periodo, estratta in un solo passaggio
+            period_metrics = []
+            
+            for period, period_results in results.items():
+                metrics_array = np.array(
+                    [(r['total_return'], r['sharpe_ratio'], r['max_drawdown']) for r in period_results],
+                    dtype=np.float64).reshape(-1, 3)
+                period_metrics.append(metrics_array)
+                mean_return, mean_sharpe, mean_drawdown = metrics_array.mean(axis=0)
                 
-                # Nella parte di test, dopo aver caricato il modello
-                print("\nInizio valutazione dettagliata sul dataset di test...")
-                test_env.reset()
-                state = test_env.get_state()
-                done = test_env.done
+                print(f"\nPeriod: {period}")
+                print(f"Mean Return: {mean_return:.2f}%")
+                print(f"Mean Sharpe: {mean_sharpe:.2f}")
+                print(f"Mean Drawdown: {mean_drawdown:.2f}%")
+            
+            mean_return, mean_sharpe, mean_drawdown = np.concatenate(period_metrics or [np.empty((0, 3))]).mean(axis=0)
+            print("\nOverall Performance:")
+            print(f"Mean Return: {mean_return:.2f}%")
+            print(f"Mean Sharpe: {mean_sharpe:.2f}")
+            print(f"Mean Drawdown: {mean_drawdown:.2f}%")
+            
+            # Save detailed backtest results
+            backtest_results_file = f'{output_dir}\\test\\backtest_results.json'
+            with open(backtest_results_file, 'w') as f:
+                # Convert numpy arrays to lists for serialization
+                serializable_results = {
+                    period: [{k: v if not isinstance(v, np.ndarray) else v.tolist() 
+                            for k, v in r.items()} 
+                            for r in period_results]
+                    for period, period_results in results.items()
+                }
+                json.dump(serializable_results, f, indent=4)
+            
+            print(f"Detailed backtest results saved to: {backtest_results_file}")
+            
+        else:
+            # Standard evaluation without backtesting framework
+            # Nella parte di test, dopo aver caricato il modello
+            print("\nInizio valutazione dettagliata sul dataset di test...")
+            test_env.reset()
+            state = test_env.get_state()
+            done = test_env.done
 
-                # Crea strutture dati per il logging
-                action_log = []
-                position_log = []
-                portfolio_value_log = []
-                rewards_log = []
+            # Crea strutture dati per il logging: array preallocati (al piu' uno step per riga di test)
+            max_test_steps = len(next(iter(aligned_dfs_test.values())))
+            action_log = np.empty((max_test_steps, test_env.num_assets), dtype=np.float32)
+            # Lo storico delle posizioni serve solo alle correlazioni di --verbose_test_analytics
+            position_log = None
+            if args.verbose_test_analytics:
+                position_log = np.empty((max_test_steps, test_env.num_assets), dtype=np.float32)
+            portfolio_value_log = np.empty(max_test_steps, dtype=np.float64)
+            rewards_log = np.empty(max_test_steps, dtype=np.float64)
+            # CVaR campionato ogni cvar_every step
+            cvar_every = 20
+            test_cvars = np.empty(max_test_steps // cvar_every + 1, dtype=np.float64)
+            # Statistiche per asset delle posizioni accumulate durante il test (un solo passaggio)
+            pos_sum = np.zeros(test_env.num_assets)
+            pos_sq_sum = np.zeros(test_env.num_assets)
+            pos_abs_sum = np.zeros(test_env.num_assets)
+            max_positions = np.full(test_env.num_assets, -np.inf)
+            min_positions = np.full(test_env.num_assets, np.inf)
 
-                step_counter = 0
-                significant_trade_counter = 0
+            step_counter = 0
+            significant_trade_counter = 0
 
+            # Un solo contesto di inferenza per tutto l'episodio di test (niente autograd, niente version counter)
+            with torch.inference_mode():
                 while not done:
-                    with torch.no_grad():
-                        actions = agent.act(state, noise=False)
-                    
+                    actions = agent.act(state, noise=False)
+                
                     # Log prima dell'azione
                     if step_counter % 20 == 0 or np.any(np.abs(actions) > 0.1):  # Log ogni 20 step o per azioni significative
                         print(f"\nStep {step_counter}:")
                         print(f"Posizioni correnti: {test_env.positions}")
                         print(f"Azioni: {actions}")
                         print(f"Portfolio value: ${test_env.get_portfolio_value():.2f}")
-                    
+                
                     reward = test_env.step(actions)
                     state = test_env.get_state()
                     done = test_env.done
-                    
+                
                     # Registra se l'operazione era significativa
                     if np.any(np.abs(actions) > 0.05):
                         significant_trade_counter += 1
-                    
-                    # Salva i log
-                    action_log.append(actions)
-                    position_log.append(test_env.positions.copy())
-                    portfolio_value_log.append(test_env.get_portfolio_value())
-                    rewards_log.append(reward)
-                    
+                
+                    # Salva i log (l'assegnazione copia nella riga, niente .copy())
+                    action_log[step_counter] = actions
+                    portfolio_value_log[step_counter] = test_env.get_portfolio_value()
+                    rewards_log[step_counter] = reward
+                    if args.verbose_test_analytics:
+                        positions = test_env.positions
+                        position_log[step_counter] = positions
+                        pos_sum += positions
+                        pos_sq_sum += positions * positions
+                        pos_abs_sum += np.abs(positions)
+                        np.maximum(max_positions, positions, out=max_positions)
+                        np.minimum(min_positions, positions, out=min_positions)
+                    if step_counter % cvar_every == 0:
+                        test_cvars[step_counter // cvar_every] = test_env.calculate_conditional_value_at_risk()
+                
                     step_counter += 1
+            
+            action_log = action_log[:step_counter]
+            if position_log is not None:
+                position_log = position_log[:step_counter]
+            portfolio_value_log = portfolio_value_log[:step_counter]
+            rewards_log = rewards_log[:step_counter]
+            test_cvars = test_cvars[:(step_counter - 1) // cvar_every + 1]
 
+            # Analisi dettagliate di posizioni, correlazioni e diversificazione solo su richiesta
+            if args.verbose_test_analytics:
                 # Stampa riepilogo delle operazioni
                 print("\n===== RIEPILOGO STRATEGIE =====")
                 print(f"Numero totale di step: {step_counter}")
@@ -999,9 +1065,8 @@ def main(args):
                 print(f"Percentuale di step con trading: {significant_trade_counter/step_counter*100:.2f}%")
 
                 # Analisi delle posizioni
-                avg_positions = np.mean(position_log, axis=0)
-                max_positions = np.max(position_log, axis=0)
-                min_positions = np.min(position_log, axis=0)
+                n_steps = max(step_counter, 1)
+                avg_positions = pos_sum / n_steps
 
                 print("\n===== ANALISI POSIZIONI =====")
                 print("Asset\tMedia\tMax\tMin")
@@ -1010,24 +1075,31 @@ def main(args):
 
                 # Calcola la correlazione tra le posizioni
                 if len(position_log) > 5:
-                    position_data = np.array(position_log)
                     print("\n===== CORRELAZIONI TRA POSIZIONI =====")
-                    corr_matrix = np.corrcoef(position_data.T)
-                    for i in range(len(test_env.tickers)):
-                        for j in range(i+1, len(test_env.tickers)):
-                            if not np.isnan(corr_matrix[i, j]):
-                                print(f"Correlazione {test_env.tickers[i]}-{test_env.tickers[j]}: {corr_matrix[i, j]:.4f}")
+                    # Correlazione in float32 con un solo prodotto matriciale sulle posizioni standardizzate
+                    std_positions = position_log.std(axis=0)
+                    standardized = (position_log - position_log.mean(axis=0)) / np.where(std_positions > 0, std_positions, 1.0)
+                    corr_matrix = (standardized.T @ standardized) / len(position_log)
+                    # Solo il triangolo superiore; asset a varianza nulla esclusi (come i NaN di np.corrcoef),
+                    # maschera calcolata in NumPy e righe scritte con un'unica print
+                    rows, cols = np.triu_indices(len(test_env.tickers), 1)
+                    valid = (std_positions[rows] > 0) & (std_positions[cols] > 0)
+                    rows, cols = rows[valid], cols[valid]
+                    lines = [f"Correlazione {test_env.tickers[i]}-{test_env.tickers[j]}: {value:.4f}"
+                             for i, j, value in zip(rows, cols, corr_matrix[rows, cols])]
+                    if lines:
+                        print("\n".join(lines))
 
                 # Analizza se l'agente sta effettivamente facendo trading o rimanendo inattivo
                 print("\n===== ATTIVITÀ DI TRADING =====")
-                variance_positions = np.var(position_log, axis=0)
+                variance_positions = np.maximum(pos_sq_sum / n_steps - avg_positions ** 2, 0.0)
                 print(f"Varianza delle posizioni: {variance_positions}")
                 if np.all(variance_positions < 0.01):
                     print("ATTENZIONE: L'agente è praticamente inattivo - varianza di posizione troppo bassa")
-                    
+                
                 # Analisi di diversificazione
                 print("\n===== METRICHE DI DIVERSIFICAZIONE =====")
-                avg_abs_positions = np.mean(np.abs(position_log), axis=0)
+                avg_abs_positions = pos_abs_sum / n_steps
                 if np.all(avg_abs_positions < 0.05):
                     print("ATTENZIONE: Agente troppo conservativo - posizioni medie troppo piccole")
                 elif np.sum(avg_abs_positions > 0.5) == 1:
@@ -1036,43 +1108,48 @@ def main(args):
                     concentration = np.sum(avg_abs_positions**2) / (np.sum(avg_abs_positions)**2)
                     print(f"Indice di concentrazione: {concentration:.4f} (valori più bassi = maggiore diversificazione)")
 
-                # Stampa risultati finali
-                metrics = test_env.get_real_portfolio_metrics()
-                print("\n===== RISULTATI FINALI =====")
-                print(f"Rendimento totale: {metrics['total_return']:.2f}%")
-                print(f"Sharpe ratio: {metrics['sharpe_ratio']:.2f}")
-                print(f"Max drawdown: {metrics['max_drawdown']:.2f}%")
-                print(f"Valore finale portafoglio: ${metrics['final_portfolio_value']:.2f}")
+            # Stampa risultati finali
+            metrics = test_env.get_real_portfolio_metrics()
+            print("\n===== RISULTATI FINALI =====")
+            print(f"Rendimento totale: {metrics['total_return']:.2f}%")
+            print(f"Sharpe ratio: {metrics['sharpe_ratio']:.2f}")
+            print(f"Max drawdown: {metrics['max_drawdown']:.2f}%")
+            print(f"Valore finale portafoglio: ${metrics['final_portfolio_value']:.2f}")
+            if len(test_cvars):
+                print(f"CVaR medio (95%, ogni {cvar_every} step): {test_cvars.mean():.4f}")
+            for name in ('total_return', 'sharpe_ratio', 'max_drawdown', 'volatility', 'final_portfolio_value'):
+                writer.add_scalar(f"test/{name}", metrics[name], 0)
+            
+            # If using market regimes, analyze performance by regime
+            if args.use_market_regimes and regime_detector is not None:
+                price_history = test_env.get_price_window(0)
                 
-                # If using market regimes, analyze performance by regime
-                if args.use_market_regimes and regime_detector is not None:
-                    ticker = test_env.tickers[0]
-                    price_history = np.array(test_env.price_history[ticker])
-                    regimes = []
-                    
-                    # Detect regimes at each step
-                    for i in range(regime_detector.window_size, len(price_history)):
-                        window = price_history[i-regime_detector.window_size:i]
-                        regime = regime_detector.detect_regime(window)
-                        regimes.append(regime)
-                    
-                    # Group rewards by regime
-                    regime_rewards = {}
-                    for regime, reward in zip(regimes, test_rewards[-len(regimes):]):
-                        if regime not in regime_rewards:
-                            regime_rewards[regime] = []
-                        regime_rewards[regime].append(reward)
+                # Detect regimes at each step in one sweep: rendimenti calcolati una volta sulla serie,
+                # HMM stimato una volta sola e decodifica di tutte le finestre in un'unica chiamata
+                # (finestre che terminano prima dell'ultimo prezzo, come nel loop per step originale)
+                regime_detector.reset()
+                regimes = regime_detector.detect_regime_series(price_history[:-1])
+                
+                # Group rewards by regime (ricompense degli ultimi len(regimes) step)
+                n = min(len(regimes), len(rewards_log))
+                if n > 0:
+                    regime_ids, regime_index = np.unique(regimes[len(regimes) - n:], return_inverse=True)
+                    rewards = rewards_log[len(rewards_log) - n:]
+                    days = np.bincount(regime_index)
+                    mean_rewards = np.bincount(regime_index, weights=rewards) / days
+                    std_rewards = np.sqrt(np.maximum(
+                        np.bincount(regime_index, weights=rewards ** 2) / days - mean_rewards ** 2, 0.0))
                     
                     print("\nPerformance by Market Regime:")
-                    for regime, rewards in regime_rewards.items():
+                    for regime, mean_r, std_r, n_days in zip(regime_ids, mean_rewards, std_rewards, days):
                         print(f"Regime {regime}:")
-                        print(f"  Mean Reward: {np.mean(rewards):.4f}")
-                        print(f"  Std Reward: {np.std(rewards):.4f}")
-                        print(f"  Days in Regime: {len(rewards)}")
-        else:
-            print("No model found for evaluation.")
+                        print(f"  Mean Reward: {mean_r:.4f}")
+                        print(f"  Std Reward: {std_r:.4f}")
+                        print(f"  Days in Regime: {n_days}")
     else:
         print("No model found for evaluation.")
+    
+    writer.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Enhanced Portfolio Training with Advanced DRL Features')
@@ -1110,6 +1187,12 @@ if __name__ == "__main__":
                       help='Number of free trades per month')
     parser.add_argument('--learning_setup', type=str, choices=['full', 'fast'], default='full',
                       help='Choose between full or fast training setup')
+    parser.add_argument('--compile', action=argparse.BooleanOptionalAction, default=None,
+                      help='Compile actor/critic forward with torch.compile (default: on with CUDA, off on CPU)')
+    parser.add_argument('--tensorboard_log_interval', type=int, default=10,
+                      help='Compute and log enhanced metrics every N episodes')
+    parser.add_argument('--verbose_test_analytics', action='store_true',
+                      help='Print the detailed position/correlation/diversification analysis after testing')
     
     args = parser.parse_args()
     